@@ -0,0 +1,102 @@
+from p3bamboo.BamFile import BamFile
+from p3bamboo.BamObject import BamObject
+from p3bamboo.BamObjectRecord import BamObjectRecord
+from p3bamboo.StructDatagram import StructDatagram
+import argparse
+import random
+
+"""
+  P3BAMBOO
+  Synthetic BAM file generator for benchmarks
+
+  Files are generated deterministically from their parameters and seed.
+"""
+
+MESH_TYPE = 'BenchmarkMesh'
+
+class BenchmarkMesh(BamObject):
+    # A registered type with PTA arrays, to exercise array decoding.
+
+    def load(self, di):
+        self.vertices = self.bam_file.read_vec3_array(di)
+        self.indices = self.bam_file.read_ushort_array(di)
+
+    def write(self, write_version, dg):
+        self.bam_file.write_vec3_array(dg, self.vertices)
+        self.bam_file.write_ushort_array(dg, self.indices)
+
+def get_type_names(depth):
+    return [f'BenchmarkType{i}' for i in range(depth)]
+
+def generate_bam(num_objects=10000, payload_size=64, depth=4, pta_size=0, pta_share=4, stdfloat_double=False, seed=0):
+    # Objects are spread over a chain of depth types, each deriving from the previous one.
+    # With pta_size, every fourth object is a mesh with PTA arrays of pta_size elements,
+    # and only every pta_share-th mesh defines new arrays: the others share the previous ones.
+    rng = random.Random(seed)
+    bam = BamFile()
+    bam.version = (6, 45)
+    bam.bam_major_ver, bam.bam_minor_ver = bam.version
+    bam.file_endian = 1
+    bam.stdfloat_double = stdfloat_double
+
+    handle_ids = []
+
+    for i, name in enumerate(get_type_names(depth)):
+        handle_id = i + 1
+        bam.register_handle(handle_id, name, handle_ids[-1:])
+        handle_ids.append(handle_id)
+
+    mesh_handle_id = len(handle_ids) + 1
+    bam.register_handle(mesh_handle_id, MESH_TYPE, handle_ids[-1:])
+
+    vec_format = '<d' if stdfloat_double else '<f'
+    ipd_pointer = 0
+    num_meshes = 0
+
+    for obj_id in range(1, num_objects + 1):
+        if pta_size and obj_id % 4 == 0:
+            dg = StructDatagram(stdfloat_double=stdfloat_double)
+
+            if num_meshes % pta_share == 0:
+                # Define two new arrays
+                ipd_pointer += 2
+                dg.add_uint16(ipd_pointer - 1)
+                dg.add_uint32(pta_size)
+                dg.add_vec_array(vec_format, [(rng.random(), rng.random(), rng.random()) for _ in range(pta_size)])
+                dg.add_uint16(ipd_pointer)
+                dg.add_uint32(pta_size)
+                dg.add_uint16_array([rng.randrange(pta_size) for _ in range(pta_size)])
+            else:
+                dg.add_uint16(ipd_pointer - 1)
+                dg.add_uint16(ipd_pointer)
+
+            num_meshes += 1
+            handle_id = mesh_handle_id
+            data = dg.get_message()
+        else:
+            handle_id = rng.choice(handle_ids)
+            size = rng.randrange(payload_size * 2 + 1)
+            data = rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+        bam.add_object(BamObjectRecord(handle_id, bam.type_handles[handle_id]['name'], obj_id, data))
+
+    return bam
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic BAM file.')
+    parser.add_argument('output')
+    parser.add_argument('--objects', type=int, default=10000)
+    parser.add_argument('--payload-size', type=int, default=64)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--pta-size', type=int, default=0)
+    parser.add_argument('--double', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    bam = generate_bam(args.objects, args.payload_size, args.depth, args.pta_size, stdfloat_double=args.double, seed=args.seed)
+
+    with open(args.output, 'wb') as f:
+        bam.write(f)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+from benchmarks.generate import BenchmarkMesh, MESH_TYPE, generate_bam, get_type_names
+from p3bamboo.BamFactory import BamFactory
+from p3bamboo.BamFile import BamFile
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+  P3BAMBOO
+  Benchmark suite
+
+  Usage: python -m benchmarks.run [--output results.json] [--repeat 3] [--scale 1.0]
+  Results are written as JSON, so that runs can be compared across commits.
+"""
+
+# name: generate_bam parameters
+# min_objects keeps a scenario meaningful when it is scaled down.
+SCENARIOS = {
+    'small_objects': {'num_objects': 50000, 'payload_size': 16},
+    'large_payloads': {'num_objects': 2000, 'payload_size': 65536},
+    'long_pointers': {'num_objects': 70000, 'payload_size': 32, 'min_objects': 70000},
+    'deep_hierarchy': {'num_objects': 20000, 'payload_size': 32, 'depth': 64},
+    'pta_arrays': {'num_objects': 4000, 'payload_size': 32, 'pta_size': 2048},
+    'pta_arrays_float64': {'num_objects': 4000, 'payload_size': 32, 'pta_size': 2048, 'stdfloat_double': True},
+}
+
+def measure(function, repeat):
+    # Returns the best time out of repeat runs, and the last result.
+    best = None
+    result = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+def load_bytes(data, **options):
+    bam = BamFile()
+
+    for key, value in options.items():
+        setattr(bam, key, value)
+
+    bam.load(io.BytesIO(data))
+    return bam
+
+def write_bytes(bam):
+    f = io.BytesIO()
+    bam.write(f)
+    return f.getvalue()
+
+def run_scenario(params, repeat):
+    data = write_bytes(generate_bam(**params))
+    depth = params.get('depth', 4)
+    results = {'params': params, 'file_size': len(data)}
+
+    results['load'], bam = measure(lambda: load_bytes(data), repeat)
+    results['load_zero_copy'], _ = measure(lambda: load_bytes(data, zero_copy=True), repeat)
+    results['load_lazy'], _ = measure(lambda: load_bytes(data, lazy_load=True), repeat)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'benchmark.bam')
+
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        def load_path():
+            bam = BamFile()
+            bam.load_path(path, mmap=True)
+            return bam
+
+        def scan():
+            with open(path, 'rb') as f:
+                return BamFile().build_index(f)
+
+        results['load_path_mmap'], _ = measure(load_path, repeat)
+        results['build_index'], _ = measure(scan, repeat)
+
+    results['write'], written = measure(lambda: write_bytes(bam), repeat)
+    results['round_trip'], _ = measure(lambda: write_bytes(load_bytes(data)), repeat)
+    results['round_trip_identical'] = written == data
+
+    # Type queries
+    type_names = get_type_names(depth) + [MESH_TYPE]
+    results['get_object_ids_of_type'], _ = measure(lambda: [list(bam.get_object_ids_of_type(name)) for name in type_names], repeat)
+    results['get_objects_of_type'], _ = measure(lambda: [list(bam.get_objects_of_type(name)) for name in type_names], repeat)
+    results['get_objects_of_type_subtypes'], _ = measure(lambda: [list(bam.get_objects_of_type(name, True)) for name in type_names], repeat)
+
+    # The first query of a lazily loaded file decodes the objects, so every run gets a fresh file.
+    lazy_bams = iter([load_bytes(data, lazy_load=True) for _ in range(repeat)])
+
+    def get_objects_of_type_lazy():
+        lazy_bam = next(lazy_bams)
+        return [list(lazy_bam.get_objects_of_type(name)) for name in type_names]
+
+    results['get_objects_of_type_lazy'], _ = measure(get_objects_of_type_lazy, repeat)
+    results['find_related'], _ = measure(lambda: [bam.find_related(name) for name in type_names], repeat)
+
+    return results
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the p3bamboo benchmark suite.')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of objects in every scenario.')
+    parser.add_argument('scenarios', nargs='*', help='Scenarios to run, all of them by default.')
+    args = parser.parse_args()
+
+    if not BamFactory.has_type(MESH_TYPE):
+        BamFactory.register_type(MESH_TYPE, BenchmarkMesh)
+
+    report = {
+        'commit': get_commit(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': args.repeat,
+        'scale': args.scale,
+        'scenarios': {}
+    }
+
+    for name in args.scenarios or SCENARIOS:
+        params = dict(SCENARIOS[name])
+        min_objects = params.pop('min_objects', 1)
+        params['num_objects'] = max(min_objects, int(params['num_objects'] * args.scale))
+        print(f'Running {name}...', file=sys.stderr)
+        report['scenarios'][name] = run_scenario(params, args.repeat)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
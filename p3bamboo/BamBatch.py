@@ -0,0 +1,51 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from p3bamboo.BamFactory import BamFactory
+from p3bamboo.BamFile import BamFile
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+# error is None if the file was processed successfully
+BamBatchResult = namedtuple('BamBatchResult', ['path', 'result', 'error'])
+
+def init_worker(types):
+    # Workers don't necessarily inherit our registered types (spawned processes don't).
+    BamFactory.types.update(types)
+
+def load_one(path, fn=None, mmap=False):
+    bam = BamFile()
+
+    if fn is None:
+        # The BAM file itself is sent back, so it must not reference a mapping.
+        bam.load_path(path, mmap=False)
+        return bam
+
+    bam.load_path(path, mmap=mmap)
+    return fn(bam)
+
+def load_many(paths, workers=None, fn=None, mmap=False):
+    # Loads BAM files in a pool of worker processes, and calls fn(bam) on each one in the worker.
+    # Yields a BamBatchResult for each file as soon as it is done, in completion order.
+    # fn must be picklable, which means it must be a module-level function.
+    # Without fn, the loaded BamFile instances themselves are returned.
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(dict(BamFactory.types),)) as executor:
+        futures = {executor.submit(load_one, path, fn, mmap): path for path in paths}
+
+        try:
+            for future in as_completed(futures):
+                path = futures[future]
+
+                try:
+                    yield BamBatchResult(path, future.result(), None)
+                except Exception as e:
+                    yield BamBatchResult(path, None, e)
+        finally:
+            # Don't load the rest of the files if we've been interrupted.
+            for future in futures:
+                future.cancel()
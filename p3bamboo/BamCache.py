@@ -0,0 +1,130 @@
+from p3bamboo.BamFile import BamFile
+from p3bamboo.BamGlobals import BAMException
+from p3bamboo.BamIndex import BamIndex
+from p3bamboo.StructDatagram import StructDatagramException
+import hashlib
+import mmap
+import os
+import tempfile
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+class BamCache(object):
+    # An on-disk cache of parsed BAM file structures.
+    # Entries are BAM indexes, keyed by the size, modification time and contents of a file.
+    # Warm loads skip walking the datagrams and only have to read (or map) the file.
+    EXTENSION = '.idx'
+
+    def __init__(self, cache_dir, max_size=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, path):
+        stat = os.stat(path)
+        content_hash = hashlib.blake2b()
+
+        if stat.st_size > 0:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                content_hash.update(mapping)
+
+        key = hashlib.blake2b(digest_size=20)
+        key.update(f'{stat.st_size}:{stat.st_mtime_ns}:'.encode('utf-8'))
+        key.update(content_hash.digest())
+        return key.hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, key + self.EXTENSION)
+
+    def get_index(self, path):
+        # Returns the cached index of a file, or None.
+        return self.read_entry(self.get_key(path))
+
+    def put_index(self, path, index):
+        self.write_entry(self.get_key(path), index)
+
+    def read_entry(self, key):
+        entry_path = self.get_entry_path(key)
+
+        try:
+            with open(entry_path, 'rb') as f:
+                index = BamIndex()
+                index.load(f)
+        except FileNotFoundError:
+            return None
+        except (BAMException, StructDatagramException):
+            # A damaged entry is as good as a missing one.
+            os.unlink(entry_path)
+            return None
+
+        # Most recently used entries are evicted last.
+        os.utime(entry_path)
+        return index
+
+    def write_entry(self, key, index):
+        entry_path = self.get_entry_path(key)
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                index.write(f)
+
+            os.replace(temp_path, entry_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.EXTENSION):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        entries.sort()
+
+        for mtime, size, entry_path in entries:
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.unlink(entry_path)
+            except FileNotFoundError:
+                pass
+
+            total_size -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.EXTENSION):
+                os.unlink(entry.path)
+
+    def load(self, path, bam=None, mmap=False):
+        # Loads a BAM file through the cache, building its index if it's not cached yet.
+        if bam is None:
+            bam = BamFile()
+
+        key = self.get_key(path)
+        index = self.read_entry(key)
+
+        if index is None:
+            with open(path, 'rb') as f:
+                index = bam.build_index(f)
+
+            index.set_source(path)
+            self.write_entry(key, index)
+
+        bam.load_from_index(path, index, mmap)
+        return bam
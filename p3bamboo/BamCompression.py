@@ -0,0 +1,156 @@
+from p3bamboo.BamGlobals import BAMException
+import queue
+import threading
+import zlib
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+CHUNK_SIZE = 1 << 16
+
+# Compression formats: wbits for zlib
+COMPRESSION_WBITS = {
+    # Panda3D .pz files
+    'zlib': zlib.MAX_WBITS,
+    'gzip': zlib.MAX_WBITS | 16
+}
+
+def get_compression(prefix):
+    # Detects the compression format of a stream from its first two bytes, or returns None.
+    if len(prefix) < 2:
+        return None
+
+    if prefix[0] == 0x1F and prefix[1] == 0x8B:
+        return 'gzip'
+
+    if prefix[0] & 0x0F == 8 and (prefix[0] << 8 | prefix[1]) % 31 == 0:
+        return 'zlib'
+
+    return None
+
+class BamDecompressor(object):
+    # A file-like object that decompresses a zlib or gzip stream as it is being read.
+    # A background thread reads and decompresses ahead of the reader, by at most max_chunks chunks,
+    # so that decompression overlaps with parsing while memory use stays bounded.
+
+    def __init__(self, f, prefix=b'', chunk_size=CHUNK_SIZE, max_chunks=4):
+        self.f = f
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(max_chunks)
+        self.buffer = bytearray()
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.decompress()
+        except zlib.error as e:
+            self.put(BAMException(f'Invalid compressed BAM stream: {e}'))
+        except BaseException as e:
+            self.put(e)
+
+    def decompress(self):
+        decompressor = None
+        data = self.prefix
+        self.prefix = None
+
+        while True:
+            if not data:
+                data = self.f.read(self.chunk_size)
+
+                if not data:
+                    break
+
+            if decompressor is None:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+            # Output is limited to a chunk per call, the rest of the input is kept for later.
+            chunk = decompressor.decompress(data, self.chunk_size)
+            data = decompressor.unconsumed_tail
+
+            if chunk and not self.put(chunk):
+                return
+
+            if decompressor.eof:
+                # gzip files can consist of multiple members.
+                data = decompressor.unused_data
+                decompressor = None
+
+        if decompressor is not None:
+            raise BAMException('Truncated compressed BAM stream.')
+
+        self.put(None)
+
+    def put(self, item):
+        # Returns False if the reader has gone away.
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            item = self.chunks.get()
+
+            if item is None:
+                self.finished = True
+            elif isinstance(item, BaseException):
+                self.finished = True
+                raise item
+            else:
+                self.buffer.extend(item)
+
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+
+        return data
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BamCompressor(object):
+    # A file-like object that compresses everything written to it, and writes it to f.
+    # finish() must be called after the last write. f itself is not closed.
+
+    def __init__(self, f, compression='zlib', level=6):
+        if compression not in COMPRESSION_WBITS:
+            raise BAMException(f'Unknown compression format: {compression}')
+
+        self.f = f
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS[compression])
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+
+        if data:
+            self.f.write(data)
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def finish(self):
+        self.f.write(self.compressor.flush())
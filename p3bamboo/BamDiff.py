@@ -0,0 +1,292 @@
+from p3bamboo.BamFile import BamFile
+from p3bamboo.BamGlobals import BAMException
+from p3bamboo.BamObjectRecord import BamObjectRecord
+from p3bamboo.StructDatagram import StructDatagram, StructDatagramIterator, UINT32
+from p3bamboo import BamGlobals
+import hashlib
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+HEADER = b'p3bdif\x00\x01'
+DIGEST_SIZE = 16
+
+# Patch operations
+OP_COPY = 0
+OP_INSERT = 1
+OP_END = 2
+
+# A patch lists the objects of the new BAM file in stream order.
+# Unchanged objects are copied from the old file in runs, changed and new objects are inserted.
+# Copies only ever go forward in the old file, so that the patch can be applied in one pass over it.
+# Embedded files are copied from the old file if their contents are unchanged, and inserted otherwise.
+
+def get_hash(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+def get_file_data_hash(bam, data):
+    file_hash = hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+    for chunk in bam.iter_file_data_chunks(data):
+        file_hash.update(chunk)
+
+    return file_hash.digest()
+
+def update_digest(digest, obj):
+    # The digest of a BAM file covers the IDs and payloads of all of its objects, in stream order.
+    digest.update(UINT32.pack(obj['obj_id']))
+    digest.update(get_hash(obj['data']))
+
+def iter_payloads(bam):
+    # Yields every object of the BAM file with its payload, exactly as it would be written.
+    bam.begin_write()
+
+    try:
+        for obj in bam.objects.values():
+            yield obj, bam.pack_object(BamGlobals.BOC_adjunct, obj, bam.written_handles)[2]
+    finally:
+        bam.end_write()
+
+def diff(old, new, f):
+    # Writes a patch that turns the BAM file old into the BAM file new to f.
+    # Objects are matched by object ID, and compared by the hashes of their payloads.
+    old_objects = {}
+    old_digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+    for position, obj in enumerate(old.objects.values()):
+        old_objects[obj['obj_id']] = (position, obj['handle_name'], get_hash(obj['data']))
+        update_digest(old_digest, obj)
+
+    old_file_datas = {}
+
+    for i, data in enumerate(old.file_datas):
+        old_file_datas.setdefault(get_file_data_hash(old, data), i)
+
+    dg = StructDatagram()
+    dg.append_data(HEADER)
+    dg.add_uint16(new.version[0])
+    dg.add_uint16(new.version[1])
+    dg.add_uint8(new.file_endian)
+    dg.add_bool(new.stdfloat_double)
+    dg.add_uint32(len(old_objects))
+    dg.append_data(old_digest.digest())
+    dg.add_uint32(len(new.type_handles))
+
+    for handle_id, handle in new.type_handles.items():
+        dg.add_uint16(handle_id)
+        dg.add_string(handle['name'])
+        dg.add_uint8(len(handle['parent_classes']))
+        dg.add_uint16_array(handle['parent_classes'])
+
+    f.write(dg.get_view())
+
+    run_start = 0
+    run_count = 0
+    last_position = -1
+
+    def write_run():
+        if run_count > 0:
+            dg = StructDatagram()
+            dg.add_uint8(OP_COPY)
+            dg.add_uint32(run_start)
+            dg.add_uint32(run_count)
+            f.write(dg.get_view())
+
+    for obj, payload in iter_payloads(new):
+        old_obj = old_objects.get(obj['obj_id'])
+
+        if old_obj is not None and old_obj[0] > last_position and old_obj[1] == obj['handle_name'] and old_obj[2] == get_hash(payload):
+            position = old_obj[0]
+
+            if run_count > 0 and position == run_start + run_count:
+                run_count += 1
+            else:
+                write_run()
+                run_start = position
+                run_count = 1
+
+            last_position = position
+            continue
+
+        write_run()
+        run_count = 0
+
+        dg = StructDatagram()
+        dg.add_uint8(OP_INSERT)
+        dg.add_uint16(obj['handle_id'])
+        dg.add_uint32(obj['obj_id'])
+        dg.add_uint64(len(payload))
+        f.write(dg.get_view())
+        f.write(payload)
+
+    write_run()
+    f.write(bytes([OP_END]))
+
+    for data in new.file_datas:
+        i = old_file_datas.get(get_file_data_hash(new, data))
+        dg = StructDatagram()
+
+        if i is not None:
+            dg.add_uint8(OP_COPY)
+            dg.add_uint32(i)
+            f.write(dg.get_view())
+            continue
+
+        dg.add_uint8(OP_INSERT)
+        dg.add_uint64(len(data))
+        f.write(dg.get_view())
+        f.writelines(new.iter_file_data_chunks(data))
+
+    f.write(bytes([OP_END]))
+
+def read_patch(data):
+    # Returns the header of the patch, its object operations and its file data operations.
+    # Inserted data is referenced, not copied.
+    di = StructDatagramIterator(data, zero_copy=True)
+
+    if di.get_remaining_size() < len(HEADER) or di.extract_bytes(len(HEADER)) != HEADER:
+        raise BAMException('Invalid BAM patch header.')
+
+    patch = {
+        'version': (di.get_uint16(), di.get_uint16()),
+        'file_endian': di.get_uint8(),
+        'stdfloat_double': di.get_bool(),
+        'num_old_objects': di.get_uint32(),
+        'old_digest': bytes(di.extract_bytes(DIGEST_SIZE)),
+        'type_handles': {},
+        'objects': [],
+        'file_datas': []
+    }
+
+    for _ in range(di.get_uint32()):
+        handle_id = di.get_uint16()
+        name = di.get_string()
+        parent_classes = di.get_uint16_array(di.get_uint8())
+        patch['type_handles'][handle_id] = {'name': name, 'parent_classes': parent_classes}
+
+    while True:
+        op = di.get_uint8()
+
+        if op == OP_END:
+            break
+        elif op == OP_COPY:
+            patch['objects'].append((op, di.get_uint32(), di.get_uint32()))
+        elif op == OP_INSERT:
+            handle_id = di.get_uint16()
+
+            if handle_id not in patch['type_handles']:
+                raise BAMException(f'Unknown type handle {handle_id} in BAM patch.')
+
+            obj_id = di.get_uint32()
+            payload = di.extract_bytes(di.get_uint64())
+            patch['objects'].append((op, BamObjectRecord(handle_id, patch['type_handles'][handle_id]['name'], obj_id, payload)))
+        else:
+            raise BAMException(f'Invalid BAM patch operation: {op}')
+
+    while True:
+        op = di.get_uint8()
+
+        if op == OP_END:
+            break
+        elif op == OP_COPY:
+            patch['file_datas'].append((op, di.get_uint32()))
+        elif op == OP_INSERT:
+            patch['file_datas'].append((op, di.extract_bytes(di.get_uint64())))
+        else:
+            raise BAMException(f'Invalid BAM patch operation: {op}')
+
+    if di.get_remaining_size() > 0:
+        raise BAMException('Trailing data in BAM patch.')
+
+    return patch
+
+def apply_patch(old_f, patch_f, f, file_data_spill_size=None):
+    # Applies a patch to the old BAM stream old_f, and writes the new BAM stream to f.
+    # The old stream is read once, from start to end. Embedded files that are kept
+    # are held until the end of the stream, or spilled if they are at least file_data_spill_size bytes.
+    # The old stream is verified against the patch as it is read, so f is invalid if this raises.
+    patch = read_patch(patch_f.read())
+
+    writer = BamFile()
+    writer.version = patch['version']
+    writer.bam_major_ver, writer.bam_minor_ver = patch['version']
+    writer.file_endian = patch['file_endian']
+    writer.stdfloat_double = patch['stdfloat_double']
+    writer.type_handles = patch['type_handles']
+    handle_ids = {handle['name']: handle_id for handle_id, handle in writer.type_handles.items()}
+
+    reader = BamFile()
+    reader.file_data_spill_size = file_data_spill_size
+    old_objects = reader.iter_objects(old_f, deserialize=False, keep_file_data=True)
+    old_digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    position = 0
+    num_written = 0
+
+    def read_old_object():
+        nonlocal position
+        obj = next(old_objects, (None, None))[0]
+
+        if obj is None:
+            raise BAMException('The BAM patch does not apply: the old BAM file has too few objects.')
+
+        update_digest(old_digest, obj)
+        position += 1
+        return obj
+
+    def write_object(obj):
+        nonlocal num_written
+        opcode = BamGlobals.BOC_push if num_written == 0 else BamGlobals.BOC_adjunct
+        f.writelines(writer.pack_object(opcode, obj, writer.written_handles))
+        num_written += 1
+
+    f.writelines(writer.pack_header())
+    writer.begin_write()
+
+    for op in patch['objects']:
+        if op[0] == OP_INSERT:
+            write_object(op[1])
+            continue
+
+        op, start, count = op
+
+        if start < position:
+            raise BAMException('Invalid BAM patch: copies must go forward.')
+
+        while position < start:
+            read_old_object()
+
+        for _ in range(count):
+            obj = read_old_object()
+            handle_name = obj['handle_name']
+
+            if handle_name not in handle_ids:
+                raise BAMException(f'The BAM patch does not apply: unknown type {handle_name}.')
+
+            write_object(BamObjectRecord(handle_ids[handle_name], handle_name, obj['obj_id'], obj['data']))
+
+    # The rest of the old stream still has to be verified, and might hold embedded files.
+    for obj, node in old_objects:
+        update_digest(old_digest, obj)
+        position += 1
+
+    if position != patch['num_old_objects'] or old_digest.digest() != patch['old_digest']:
+        raise BAMException('The BAM patch does not apply: the old BAM file does not match.')
+
+    for op, value in patch['file_datas']:
+        if op == OP_COPY:
+            if value >= len(reader.file_datas):
+                raise BAMException(f'The BAM patch does not apply: missing embedded file {value}.')
+
+            value = reader.file_datas[value]
+
+        f.writelines(writer.pack_file_data(value))
+
+    if writer.version >= (6, 21):
+        f.writelines(writer.pack_object(BamGlobals.BOC_pop))
+
+    writer.end_write()
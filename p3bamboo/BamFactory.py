@@ -22,6 +22,10 @@ class BamFactory(object):
 
         del BamFactory.types[handle_name]
 
+    @staticmethod
+    def has_type(handle_name):
+        return handle_name in BamFactory.types
+
     @staticmethod
     def create(bam_file, version, *handle_names):
         for handle_name in handle_names:
@@ -0,0 +1,86 @@
+from p3bamboo.BamGlobals import BAMException
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+# Fixed-size field types: (struct format, number of values)
+# A format of None is a stdfloat: float32 or float64, depending on the BAM file.
+FIXED_TYPES = {
+    'bool': ('?', 1),
+    'int8': ('b', 1),
+    'int16': ('h', 1),
+    'int32': ('i', 1),
+    'int64': ('q', 1),
+    'uint8': ('B', 1),
+    'uint16': ('H', 1),
+    'uint32': ('I', 1),
+    'uint64': ('Q', 1),
+    'float32': ('f', 1),
+    'float64': ('d', 1),
+    'stdfloat': (None, 1),
+    'vec2': ('f', 2),
+    'vec3': ('f', 3),
+    'vec4': ('f', 4),
+    'stdvec2': (None, 2),
+    'stdvec3': (None, 3),
+    'stdvec4': (None, 4)
+}
+
+# Variable-size field types, read and written by the datagram's get_<type> and add_<type> methods
+VARIABLE_TYPES = ('string', 'string32', 'z_string', 'wstring', 'blob', 'blob32')
+
+# Pointers are read and written by the BAM file, their size depends on the number of objects
+POINTER = 'pointer'
+
+class BamField(object):
+    # A field of a BamSchemaObject.
+    # count is either a fixed number of elements, or the name of an earlier field holding the number of elements.
+    # The field is only present from min_version and until (not including) max_version.
+    __slots__ = ('name', 'field_type', 'count', 'min_version', 'max_version')
+
+    def __init__(self, name, field_type, count=None, min_version=None, max_version=None):
+        if not name.isidentifier():
+            raise BAMException(f'Invalid field name: {name}')
+
+        if field_type not in FIXED_TYPES and field_type not in VARIABLE_TYPES and field_type != POINTER:
+            raise BAMException(f'Unknown type {field_type} for field {name}.')
+
+        self.name = name
+        self.field_type = field_type
+        self.count = count
+        self.min_version = min_version
+        self.max_version = max_version
+
+    def is_present(self, version):
+        if self.min_version is not None and version < self.min_version:
+            return False
+
+        if self.max_version is not None and version >= self.max_version:
+            return False
+
+        return True
+
+    def is_fixed(self):
+        # Fixed-size fields can be packed together into a single struct.
+        return self.field_type in FIXED_TYPES and not isinstance(self.count, str)
+
+    def get_format(self, stdfloat_double):
+        # Returns the struct format of one element, and the number of values in it.
+        value_format, size = FIXED_TYPES[self.field_type]
+
+        if value_format is None:
+            value_format = 'd' if stdfloat_double else 'f'
+
+        return value_format, size
+
+    def __repr__(self):
+        return f'BamField({self.name!r}, {self.field_type!r}, count={self.count!r}, min_version={self.min_version!r}, max_version={self.max_version!r})'
+
+def get_field_names(fields):
+    # Use as the __slots__ of a BamSchemaObject.
+    return tuple(field.name for field in fields)
@@ -1,9 +1,24 @@
-from collections import OrderedDict
+from p3bamboo.BamCompression import BamCompressor, BamDecompressor, get_compression
 from p3bamboo.BamFactory import BamFactory
+from p3bamboo.BamFileData import BamFileData
 from p3bamboo.BamGlobals import BAMException
-from p3bamboo.StructDatagram import StructDatagram, StructDatagramIterator
+from p3bamboo.BamIndex import BamIndex
+from p3bamboo.BamObjectMap import BamObjectMap
+from p3bamboo.BamObjectRecord import BamObjectRecord
+from p3bamboo.StructDatagram import StructDatagram, StructDatagramIterator, StructDatagramException, UINT32
 from p3bamboo import BamGlobals
+import asyncio
+import collections
+import itertools
+import mmap as mmaplib
 import os
+import tempfile
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
   P3BAMBOO
@@ -13,6 +28,9 @@ import os
   Date: 2020/10/16
 """
 
+CHUNK_SIZE = 1 << 16
+INDEX_PEEK_SIZE = 1 << 10
+
 class BamFile(object):
     HEADER = b'pbj\x00\n\r'
 
@@ -24,15 +42,49 @@ class BamFile(object):
         self.stdfloat_double = -1
         self.nesting_level = -1
         self.type_handles = {}
-        self.objects = OrderedDict()
+        self.indexed_handles = None
+        self.handle_ids = {}
+        self.handle_ancestors = {}
+        self.handle_descendants = {}
+        # Object IDs to object records, in stream order
+        self.objects = {}
+        self.indexed_objects = None
+        self.indexed_count = 0
+        self.type_objects = {}
         self.file_datas = []
         self.filename = None
         self.write_long_pointers = False
         self.read_long_pointers = False
         self.warn_truncated_data = False
+        self.zero_copy = False
+        self.use_numpy = False
         self.unknown_handles = []
-        self.object_map = {}
+        self.object_map = BamObjectMap(self)
         self.pta_map = {}
+        # Arrays are tracked by identity: id(array) -> IPD pointer
+        self.pta_pointers = {}
+        self.next_ipd_pointer = 1
+        self.written_ptas = set()
+        # Whether arrays are no longer defined where the original payloads define them
+        self.ptas_moved = False
+        self.lazy_load = False
+        self.decoding_position = None
+        self.object_index = None
+        self.index_stream = None
+        # Whether index_stream was opened by us, and has to be closed by us
+        self.owns_index_stream = False
+        # The device and inode of the file we have memory-mapped, if any
+        self.mapped_file = None
+        self.track_dirty = False
+        self.saved_objects = set()
+        # The arrays each object's original payload defines, and the ones it refers to
+        self.pta_definitions = {}
+        self.pta_references = {}
+        self.current_obj_id = None
+        # A BamStats instance, if loads and writes should be profiled
+        self.stats = None
+        # Embedded files of at least this many bytes are spilled to temporary files
+        self.file_data_spill_size = None
 
     def set_filename(self, filename):
         self.filename = os.path.abspath(filename)
@@ -41,31 +93,31 @@ class BamFile(object):
         return self.filename
 
     def get_object(self, object_id):
-        return self.object_map.get(object_id)
+        node = self.object_map.get(object_id)
+
+        if node is None and self.object_index is not None and object_id not in self.objects:
+            node = self.load_indexed_object(object_id)
+
+        return node
 
     def get_handle_id_by_name(self, handle_name):
         if not isinstance(handle_name, str):
             return handle_name
 
-        for handle_id, handle in self.type_handles.items():
-            if handle['name'] == handle_name:
-                return handle_id
+        self.check_handle_index()
+        return self.handle_ids.get(handle_name)
 
     def find_parent(self, handle_id, parent_id):
-        handle = self.type_handles[handle_id]
-        parents = list(handle['parent_classes'])
+        self.check_handle_index()
 
-        if parent_id in parents:
-            return True
-
-        for parent_class in parents:
-            if self.find_parent(parent_class, parent_id):
-                return True
+        if handle_id not in self.type_handles:
+            raise KeyError(handle_id)
 
-        return False
+        return parent_id in self.get_handle_ancestors(handle_id)
 
     def find_children(self, parent_id):
-        return [handle_id for handle_id in self.type_handles.keys() if self.find_parent(handle_id, parent_id)]
+        self.check_handle_index()
+        return list(self.handle_descendants.get(parent_id, ()))
 
     def find_related(self, parent_id):
         parent_id = self.get_handle_id_by_name(parent_id)
@@ -80,27 +132,269 @@ class BamFile(object):
 
         return children
 
-    def get_objects_of_type(self, type_name):
+    def register_handle(self, handle_id, name, parent_classes):
+        self.check_handle_index()
+        # Handles that are replaced, or that were already registered as the parent
+        # of another handle, invalidate the ancestors memoized for other handles.
+        stale = handle_id in self.type_handles or handle_id in self.handle_descendants
+        self.type_handles[handle_id] = {'name': name, 'parent_classes': parent_classes}
+
+        if stale:
+            self.rebuild_handle_index()
+        else:
+            self.index_handle(handle_id)
+
+    def check_handle_index(self):
+        # The index is rebuilt if the type handles were replaced
+        # or added to without going through register_handle.
+        if self.indexed_handles is not self.type_handles or len(self.handle_ancestors) != len(self.type_handles):
+            self.rebuild_handle_index()
+
+    def rebuild_handle_index(self):
+        self.indexed_handles = self.type_handles
+        self.handle_ids = {}
+        self.handle_ancestors = {}
+        self.handle_descendants = {}
+
+        for handle_id in self.type_handles:
+            self.index_handle(handle_id)
+
+    def index_handle(self, handle_id):
+        self.handle_ids.setdefault(self.type_handles[handle_id]['name'], handle_id)
+        self.handle_ancestors.pop(handle_id, None)
+
+        for ancestor_id in self.get_handle_ancestors(handle_id):
+            self.handle_descendants.setdefault(ancestor_id, {})[handle_id] = None
+
+    def get_handle_ancestors(self, handle_id):
+        # The transitive closure of the parents of a handle, memoized.
+        ancestors = self.handle_ancestors.get(handle_id)
+
+        if ancestors is not None:
+            return ancestors
+
+        ancestors = set()
+        handle = self.type_handles.get(handle_id)
+
+        if handle is None:
+            # Don't memoize handles we don't know about yet.
+            return ancestors
+
+        self.handle_ancestors[handle_id] = ancestors
+
+        for parent_id in handle['parent_classes']:
+            ancestors.add(parent_id)
+            ancestors.update(self.get_handle_ancestors(parent_id))
+
+        return ancestors
+
+    def get_objects_of_type(self, type_name, subtypes=False):
+        for obj_id in self.get_object_ids_of_type(type_name, subtypes):
+            if obj_id in self.object_map:
+                yield self.object_map[obj_id]
+
+    def get_object_ids_of_type(self, type_name, subtypes=False):
+        # With subtypes, objects are grouped by their exact type.
         type_id = self.get_handle_id_by_name(type_name)
 
+        if type_id is None:
+            return []
+
+        if subtypes:
+            handle_ids = self.find_related(type_id)
+        else:
+            handle_ids = [type_id]
+
+        self.check_object_index()
+        obj_ids = []
+
+        for handle_id in handle_ids:
+            obj_ids.extend(self.type_objects.get(handle_id, ()))
+
+        return obj_ids
+
+    def add_object(self, obj):
+        obj_id = obj['obj_id']
+
+        if obj_id in self.objects:
+            self.remove_object(obj_id)
+
+        self.check_object_index()
+        self.objects[obj_id] = obj
+        self.type_objects.setdefault(obj['handle_id'], {})[obj_id] = None
+        self.indexed_count += 1
+
+    def remove_object(self, obj_id):
+        self.check_object_index()
+        obj = self.objects.pop(obj_id)
+        self.type_objects[obj['handle_id']].pop(obj_id, None)
+        self.indexed_count -= 1
+
+        if obj_id in self.object_map:
+            del self.object_map[obj_id]
+
+    def check_object_index(self):
+        # The index is rebuilt if objects were added or removed
+        # without going through add_object and remove_object.
+        if self.indexed_objects is not self.objects or self.indexed_count != len(self.objects):
+            self.rebuild_object_index()
+
+    def rebuild_object_index(self):
+        self.indexed_objects = self.objects
+        self.indexed_count = len(self.objects)
+        self.type_objects = {}
+
         for obj_id, obj in self.objects.items():
-            if obj['handle_id'] == type_id and obj_id in self.object_map:
-                yield self.object_map[obj_id]
+            self.type_objects.setdefault(obj['handle_id'], {})[obj_id] = None
 
     def load(self, f):
+        header = f.read(len(self.HEADER))
+
+        if header != self.HEADER:
+            if get_compression(header) is None:
+                raise BAMException('Invalid BAM header.')
+
+            # Compressed files are decompressed while they are being parsed.
+            with BamDecompressor(f, header) as decompressor:
+                return self.load_stream(decompressor)
+
+        if self.stats is None:
+            return self.load_data(f.read())
+
+        start = time.perf_counter()
+        data = f.read()
+        self.stats.record_io(len(data), time.perf_counter() - start)
+        self.load_data(data)
+
+    def load_stream(self, f, chunk_size=CHUNK_SIZE):
+        # Loads a BAM file one datagram at a time, without reading all of it into memory first.
         if f.read(len(self.HEADER)) != self.HEADER:
             raise BAMException('Invalid BAM header.')
 
-        di = StructDatagramIterator(f.read())
-        hdi = StructDatagramIterator(self.read_datagram(di))
+        datagrams = self.iter_datagrams(f, chunk_size)
+        hdi = next(datagrams, None)
+
+        if hdi is None:
+            raise BAMException('Missing BAM header datagram.')
+
+        self.read_header(hdi)
+
+        for dgi in datagrams:
+            self.read_datagram_code(dgi)
+
+    async def aload(self, reader, executor=None):
+        # Loads a BAM file from an asyncio.StreamReader, one datagram at a time.
+        # Datagrams are decoded in batches in the executor, so that the event loop is never blocked on them.
+        loop = asyncio.get_running_loop()
+
+        try:
+            header = await reader.readexactly(len(self.HEADER))
+        except asyncio.IncompleteReadError:
+            header = None
+
+        if header != self.HEADER:
+            raise BAMException('Invalid BAM header.')
+
+        hdi = await self.aread_datagram_iterator(reader)
+
+        if hdi is None:
+            raise BAMException('Missing BAM header datagram.')
+
+        self.read_header(hdi)
+        datagrams = []
+        num_bytes = 0
+
+        while True:
+            dgi = await self.aread_datagram_iterator(reader)
+
+            if dgi is not None:
+                datagrams.append(dgi)
+                num_bytes += dgi.get_remaining_size()
+
+                if num_bytes < CHUNK_SIZE:
+                    continue
+
+            if datagrams:
+                await loop.run_in_executor(executor, self.read_datagram_codes, datagrams)
+                datagrams = []
+                num_bytes = 0
+
+            if dgi is None:
+                break
+
+    async def aread_datagram_iterator(self, reader):
+        # Reads the next datagram from an asyncio.StreamReader, or returns None at the end of the stream.
+        try:
+            prefix = await reader.readexactly(4)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+
+            raise BAMException('Truncated datagram length in BAM stream.')
 
+        num_bytes = UINT32.unpack(prefix)[0]
+
+        if num_bytes == 0xFFFFFFFF:
+            try:
+                prefix = await reader.readexactly(4)
+            except asyncio.IncompleteReadError:
+                raise BAMException('Truncated datagram length in BAM stream.')
+
+            num_bytes += UINT32.unpack(prefix)[0]
+
+        try:
+            data = await reader.readexactly(num_bytes)
+        except asyncio.IncompleteReadError as e:
+            raise BAMException(f'Truncated datagram in BAM stream: expected {num_bytes} bytes, got {len(e.partial)}.')
+
+        return StructDatagramIterator(data, zero_copy=self.zero_copy)
+
+    def load_path(self, path, mmap=False):
+        # With mmap, the file must not be modified or overwritten for as long as we use it.
+        self.set_filename(path)
+
+        with open(path, 'rb') as f:
+            # Compressed files are streamed instead of being mapped.
+            if not mmap or f.read(len(self.HEADER)) != self.HEADER:
+                f.seek(0)
+                return self.load(f)
+
+            mapping = mmaplib.mmap(f.fileno(), 0, access=mmaplib.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+
+        # Payloads stay as views into the mapping, which keep it open.
+        # Only the objects that are saved get a copy of their own.
+        self.zero_copy = True
+        self.load_data(memoryview(mapping)[len(self.HEADER):])
+        self.mapped_file = (stat.st_dev, stat.st_ino)
+
+    def load_data(self, data):
+        # Datagrams are iterated in place: the only copies made are the
+        # object payloads, and not even those in zero copy mode.
+        stats = self.stats
+
+        if stats is not None:
+            start = time.perf_counter()
+            load_time = stats.load_time
+
+        di = StructDatagramIterator(data, zero_copy=True)
+        hdi = self.read_datagram_iterator(di)
+        self.read_header(hdi)
+
+        # New object stream format: read object hierarchy
+        while di.getRemainingSize() > 0:
+            self.read_object_code(di)
+
+        if stats is not None:
+            # Everything that wasn't spent deserializing objects was spent framing them.
+            elapsed = time.perf_counter() - start - (stats.load_time - load_time)
+            stats.record_framing(len(data), elapsed)
+
+    def read_header(self, hdi):
+        # Reading a header starts a new BAM stream, so we forget the old one.
         self.bam_major_ver = hdi.get_uint16()
         self.bam_minor_ver = hdi.get_uint16()
         self.version = (self.bam_major_ver, self.bam_minor_ver)
-        self.read_long_pointers = False
-        self.type_handles = {}
-        self.file_datas = []
-        self.objects.clear()
 
         if self.version >= (5, 0):
             self.file_endian = hdi.get_uint8()
@@ -112,14 +406,46 @@ class BamFile(object):
         else:
             self.stdfloat_double = False
 
+        self.reset_stream()
+
+    def close(self):
+        # Closes the stream opened by open_index_path.
+        # Streams passed to open_index belong to the caller, and are left open.
+        if self.owns_index_stream:
+            self.index_stream.close()
+
+        self.index_stream = None
+        self.owns_index_stream = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def reset_stream(self):
+        self.close()
+        self.mapped_file = None
+        self.read_long_pointers = False
+        self.type_handles = {}
+        self.file_datas = []
+        self.objects.clear()
+        self.type_objects = {}
+        self.indexed_count = 0
+        self.object_index = None
         self.nesting_level = 0
         self.unknown_handles = []
-        self.object_map = {}
+        self.object_map = BamObjectMap(self)
         self.pta_map = {}
+        self.pta_pointers = {}
+        self.next_ipd_pointer = 1
+        self.pta_definitions = {}
+        self.pta_references = {}
 
-        # New object stream format: read object hierarchy
-        while di.getRemainingSize() > 0:
-            self.read_object_code(di)
+    def __setstate__(self, state):
+        # Arrays have new identities after being copied or unpickled.
+        self.__dict__.update(state)
+        self.pta_pointers = {id(array): ipd_pointer for ipd_pointer, array in self.pta_map.items()}
 
     def read_stdfloat(self, di):
         if self.stdfloat_double:
@@ -133,35 +459,179 @@ class BamFile(object):
         else:
             dg.add_float32(value)
 
+    def get_stdfloat_format(self):
+        if self.stdfloat_double:
+            return '<d'
+
+        return '<f'
+
     def read_ushort_array(self, di):
-        return self.read_array(di, lambda di: di.get_uint16())
+        return self.read_value_array(di, '<H')
 
     def read_int_array(self, di):
-        return self.read_array(di, lambda di: di.get_uint32())
+        return self.read_value_array(di, '<I')
 
     def read_vec2_array(self, di):
-        return self.read_array(di, BamGlobals.read_vec2)
+        return self.read_value_array(di, self.get_stdfloat_format(), 2)
 
     def read_vec3_array(self, di):
-        return self.read_array(di, BamGlobals.read_vec3)
+        return self.read_value_array(di, self.get_stdfloat_format(), 3)
 
     def read_vec4_array(self, di):
-        return self.read_array(di, BamGlobals.read_vec4)
+        return self.read_value_array(di, self.get_stdfloat_format(), 4)
+
+    def read_value_array(self, di, value_format, size=1):
+        if self.use_numpy:
+            reader = lambda di, count: self.read_numpy_array(di, value_format, count, size)
+        elif size == 1:
+            reader = lambda di, count: di.get_array(value_format, count)
+        else:
+            reader = lambda di, count: di.get_vec_array(value_format, count, size)
+
+        return self.read_array(di, reader, bulk=True)
+
+    def read_numpy_array(self, di, value_format, count, size=1):
+        if numpy is None:
+            raise BAMException('NumPy arrays were requested, but NumPy is not installed.')
+
+        dtype = numpy.dtype(value_format)
+        num_values = count * size
+        index = di.index
+
+        # Decode straight from the source buffer; copying it once
+        # makes the array writable unless we're in zero copy mode.
+        di.skip_bytes(num_values * dtype.itemsize)
+
+        if num_values == 0:
+            array = numpy.empty(0, dtype)
+        else:
+            array = numpy.frombuffer(di.data, dtype, num_values, index)
 
-    def read_array(self, di, reader):
+            if not self.zero_copy:
+                array = array.copy()
+
+        if size > 1:
+            array = array.reshape(count, size)
+
+        return array
+
+    def read_array(self, di, reader, bulk=False):
+        # A bulk reader decodes all elements of the array at once: reader(di, count)
         ipd_pointer = di.get_uint16()
 
         if ipd_pointer == 0:
             if di.get_uint32() != 0:
                 raise Exception('Expected zero length IPD array.')
 
+            if bulk:
+                return reader(di, 0)
+
             return []
 
+        if ipd_pointer not in self.pta_map and self.decoding_position is not None:
+            # We're deserializing an object lazily. The array might have
+            # been defined by an earlier object that is not loaded yet.
+            self.load_objects_before(self.decoding_position, lambda: ipd_pointer in self.pta_map)
+
         if ipd_pointer not in self.pta_map:
-            self.pta_map[ipd_pointer] = [reader(di) for i in range(di.get_uint32())]
+            count = di.get_uint32()
+
+            if bulk:
+                array = reader(di, count)
+            else:
+                array = [reader(di) for i in range(count)]
+
+            self.register_pta(ipd_pointer, array)
+            self.add_pta_definition(ipd_pointer)
+        else:
+            self.add_pta_reference(ipd_pointer)
 
         return self.pta_map[ipd_pointer]
 
+    def tracks_ptas(self):
+        # Original payloads are only written out as-is next to re-encoded ones
+        # when tracking dirty objects, or when loading objects lazily.
+        return self.current_obj_id is not None and (self.track_dirty or self.lazy_load)
+
+    def add_pta_definition(self, ipd_pointer):
+        # Remember which object's payload defines each array,
+        # so that we know when that payload can be written out as-is.
+        if self.tracks_ptas():
+            self.pta_definitions.setdefault(self.current_obj_id, []).append(ipd_pointer)
+
+    def add_pta_reference(self, ipd_pointer):
+        # Likewise, a payload that refers to an array can only be written out
+        # as-is after the payload that defines it.
+        if self.tracks_ptas():
+            self.pta_references.setdefault(self.current_obj_id, []).append(ipd_pointer)
+
+    def register_pta(self, ipd_pointer, array):
+        if ipd_pointer is None:
+            if self.object_map.pending:
+                # Objects that aren't loaded yet might define any IPD pointer we don't know of.
+                self.object_map.load_all()
+
+            ipd_pointer = self.next_ipd_pointer
+
+            if ipd_pointer > 0xFFFF:
+                raise BAMException('Too many PTA arrays: IPD pointers are limited to 16 bits.')
+
+        self.next_ipd_pointer = max(self.next_ipd_pointer, ipd_pointer + 1)
+        self.pta_map[ipd_pointer] = array
+        self.pta_pointers[id(array)] = ipd_pointer
+        return ipd_pointer
+
+    def write_ushort_array(self, dg, array):
+        self.write_value_array(dg, array, '<H')
+
+    def write_int_array(self, dg, array):
+        self.write_value_array(dg, array, '<I')
+
+    def write_vec2_array(self, dg, array):
+        self.write_value_array(dg, array, self.get_stdfloat_format(), 2)
+
+    def write_vec3_array(self, dg, array):
+        self.write_value_array(dg, array, self.get_stdfloat_format(), 3)
+
+    def write_vec4_array(self, dg, array):
+        self.write_value_array(dg, array, self.get_stdfloat_format(), 4)
+
+    def write_value_array(self, dg, array, value_format, size=1):
+        def writer(dg, array):
+            if numpy is not None and isinstance(array, numpy.ndarray):
+                array = numpy.ascontiguousarray(array, numpy.dtype(value_format))
+                dg.append_data(memoryview(array).cast('B'))
+            elif size == 1:
+                dg.add_array(value_format, array)
+            else:
+                dg.add_vec_array(value_format, array)
+
+        self.write_array(dg, array, writer)
+
+    def write_array(self, dg, array, writer):
+        # Arrays shared between objects are only written out once:
+        # every other occurrence only refers to their IPD pointer.
+        if len(array) == 0:
+            dg.add_uint16(0)
+            dg.add_uint32(0)
+            return
+
+        ipd_pointer = self.pta_pointers.get(id(array))
+
+        if ipd_pointer is None:
+            ipd_pointer = self.register_pta(None, array)
+
+        dg.add_uint16(ipd_pointer)
+
+        if ipd_pointer in self.written_ptas:
+            self.add_pta_reference(ipd_pointer)
+            return
+
+        self.written_ptas.add(ipd_pointer)
+        self.add_pta_definition(ipd_pointer)
+        dg.add_uint32(len(array))
+        writer(dg, array)
+
     def read_pointer(self, di):
         if self.read_long_pointers:
             return di.get_uint32()
@@ -231,6 +701,14 @@ class BamFile(object):
         dg = StructDatagram(data)
         return dg
 
+    def read_datagram_iterator(self, di):
+        num_bytes = di.get_uint32()
+
+        if num_bytes == 0xFFFFFFFF:
+            num_bytes += di.get_uint32()
+
+        return di.extract_iterator(num_bytes, self.zero_copy)
+
     def read_handle(self, di, parent=None):
         handle_id = di.get_uint16()
 
@@ -247,7 +725,7 @@ class BamFile(object):
             for _ in range(num_parent_classes):
                 parent_classes.append(self.read_handle(di))
 
-            self.type_handles[handle_id] = {'name': name, 'parent_classes': parent_classes}
+            self.register_handle(handle_id, name, parent_classes)
 
         return handle_id
 
@@ -266,56 +744,605 @@ class BamFile(object):
         if num_bytes == 0xFFFFFFFF:
             num_bytes = di.get_uint64()
 
-        return di.extractBytes(num_bytes)
+        spill = self.file_data_spill_size is not None and num_bytes >= self.file_data_spill_size
 
-    def read_object_code(self, di):
-        dg = self.read_datagram(di)
-        dgi = StructDatagramIterator(dg)
+        if di.zero_copy or spill:
+            # Refer to the source buffer. Data that is spilled goes straight from there to disk.
+            start = di.index
+            di.skip_bytes(num_bytes)
+            data = BamFileData(di.data, start, num_bytes)
+        else:
+            data = BamFileData(di.extract_bytes(num_bytes))
 
+        if spill:
+            data.spill()
+
+        return data
+
+    def read_opcode(self, dgi):
         if self.version >= (6, 21):
-            opcode = dgi.get_uint8()
-        else:
-            opcode = BamGlobals.BOC_adjunct
+            return dgi.get_uint8()
+
+        return BamGlobals.BOC_adjunct
+
+    def read_object_code(self, di):
+        dgi = self.read_datagram_iterator(di)
+        opcode = self.read_datagram_code(dgi)
+
+        if opcode in (BamGlobals.BOC_remove, BamGlobals.BOC_file_data):
+            return self.read_object_code(di)
+
+    def read_datagram_code(self, dgi):
+        # Reads a single datagram of the object stream, and returns its opcode.
+        opcode = self.read_opcode(dgi)
 
         if opcode == BamGlobals.BOC_push:
             self.nesting_level += 1
-            return self.read_object(dgi)
+            self.read_object(dgi)
         elif opcode == BamGlobals.BOC_pop:
             self.nesting_level -= 1
         elif opcode == BamGlobals.BOC_adjunct:
-            return self.read_object(dgi)
+            self.read_object(dgi)
         elif opcode == BamGlobals.BOC_remove:
             self.read_freed_object_codes(dgi)
-            return self.read_object_code(di)
         elif opcode == BamGlobals.BOC_file_data:
             self.file_datas.append(self.read_file_data(dgi))
-            return self.read_object_code(di)
+
+        return opcode
+
+    def read_datagram_codes(self, datagrams):
+        for dgi in datagrams:
+            self.read_datagram_code(dgi)
 
     def read_object_from_dg(self, di):
-        dg = self.read_datagram(di)
-        dgi = StructDatagramIterator(dg)
+        dgi = self.read_datagram_iterator(di)
         return self.read_object(dgi)
 
     def read_object(self, dgi):
+        obj = self.parse_object(dgi)
+        obj_id = obj['obj_id']
+        handle_name = obj['handle_name']
+
+        if self.lazy_load and BamFactory.has_type(handle_name):
+            # The object will be deserialized when it is first accessed.
+            self.object_map.add_pending(obj, self.read_long_pointers, len(self.objects))
+        else:
+            node = self.create_object(obj)
+
+            if node is not None:
+                self.object_map[obj_id] = node
+
+        if obj_id in self.objects:
+            raise BAMException(f'Object ID {obj_id} ({handle_name}) was encountered twice in the BAM stream!')
+
+        self.add_object(obj)
+
+    def parse_object(self, dgi):
         handle_id = self.read_handle(dgi)
         obj_id = self.read_pointer(dgi)
-        data = dgi.extract_bytes(dgi.get_remaining_size())
-
         handle_name = self.type_handles[handle_id]['name']
+        num_bytes = dgi.get_remaining_size()
 
-        obj = {'handle_id': handle_id, 'handle_name': handle_name, 'obj_id': obj_id, 'data': data}
+        if dgi.zero_copy:
+            # Point into the shared buffer, without creating a view per object.
+            obj = BamObjectRecord(handle_id, handle_name, obj_id, dgi.data, dgi.index, num_bytes)
+            dgi.skip_bytes(num_bytes)
+        else:
+            obj = BamObjectRecord(handle_id, handle_name, obj_id, dgi.extract_bytes(num_bytes))
+
+        if self.stats is not None:
+            self.stats.record_object(handle_name, obj_id, num_bytes)
+
+        return obj
+
+    def create_object(self, obj):
+        handle_name = obj['handle_name']
         node = BamFactory.create(self, self.version, handle_name)
 
         if node is not None:
-            node.load_object(obj)
-            self.object_map[obj_id] = node
+            current_obj_id = self.current_obj_id
+            self.current_obj_id = obj['obj_id']
+
+            try:
+                if self.stats is None:
+                    node.load_object(obj)
+                else:
+                    start = time.perf_counter()
+                    node.load_object(obj)
+                    self.stats.record_load(handle_name, obj['obj_id'], obj.get_size(), time.perf_counter() - start)
+            finally:
+                self.current_obj_id = current_obj_id
         elif handle_name not in self.unknown_handles:
             self.unknown_handles.append(handle_name)
 
-        if obj_id in self.objects:
-            raise BAMException(f'Object ID {obj_id} ({handle_name}) was encountered twice in the BAM stream!')
+        return node
 
-        self.objects[obj_id] = obj
+    def load_objects_before(self, position, condition):
+        # Deserializes objects that come before position in the stream,
+        # in order, until the condition is met.
+        self.object_map.load_before(position, condition)
+
+        if self.object_index is None:
+            return
+
+        for i in range(position):
+            if condition():
+                break
+
+            obj_id = self.object_index.obj_ids[i]
+            handle_id = self.object_index.handle_ids[i]
+
+            if obj_id not in self.objects and BamFactory.has_type(self.type_handles[handle_id]['name']):
+                self.load_indexed_object(obj_id)
+
+    def decode_object(self, obj, read_long_pointers, position):
+        # Deserializes an object outside of the stream, restoring
+        # the pointer state the object was originally read with.
+        stream_state = (self.read_long_pointers, self.decoding_position)
+        self.read_long_pointers = read_long_pointers
+        self.decoding_position = position
+
+        try:
+            return self.create_object(obj)
+        finally:
+            self.read_long_pointers, self.decoding_position = stream_state
+
+    def read_stream_header(self, f):
+        if f.read(len(self.HEADER)) != self.HEADER:
+            raise BAMException('Invalid BAM header.')
+
+        num_bytes = self.read_stream_length(f)
+
+        if num_bytes is None:
+            raise BAMException('Missing BAM header datagram.')
+
+        hdi = StructDatagramIterator(f.read(num_bytes))
+        self.read_header(hdi)
+
+    def build_index(self, f):
+        # Builds an offset index of a BAM stream in one pass.
+        # Only the length prefixes and object headers are read, payloads are seeked over.
+        self.read_stream_header(f)
+        index = BamIndex()
+
+        for opcode in self.walk_datagrams(f, index):
+            pass
+
+        return index
+
+    def probe(self, f):
+        # Reads the header of a BAM stream, and nothing else.
+        summary = {'version': None, 'file_endian': None, 'stdfloat_double': None, 'errors': [], 'valid': False}
+
+        try:
+            self.read_stream_header(f)
+        except (BAMException, StructDatagramException) as e:
+            summary['errors'].append(str(e))
+            return summary
+
+        summary['version'] = self.version
+        summary['file_endian'] = self.file_endian
+        summary['stdfloat_double'] = self.stdfloat_double
+        summary['valid'] = True
+        return summary
+
+    def scan(self, f):
+        # Checks the structure of a seekable BAM stream in one pass, the same way build_index does.
+        # No objects are created and no payloads are read.
+        # Structural errors are reported in the summary instead of being raised.
+        summary = self.probe(f)
+        errors = summary['errors']
+
+        if errors:
+            return summary
+
+        index = BamIndex()
+        nesting_level = 0
+        num_datagrams = 0
+
+        try:
+            for opcode in self.walk_datagrams(f, index):
+                num_datagrams += 1
+
+                if opcode == BamGlobals.BOC_push:
+                    nesting_level += 1
+                elif opcode == BamGlobals.BOC_pop:
+                    nesting_level -= 1
+
+                    if nesting_level < 0:
+                        errors.append(f'Unmatched pop in datagram {num_datagrams}.')
+                        nesting_level = 0
+                elif opcode not in (BamGlobals.BOC_adjunct, BamGlobals.BOC_remove, BamGlobals.BOC_file_data):
+                    errors.append(f'Invalid opcode {opcode} in datagram {num_datagrams}.')
+        except (BAMException, StructDatagramException) as e:
+            errors.append(f'Datagram {num_datagrams + 1}: {e}')
+
+        if nesting_level > 0 and self.version >= (6, 21):
+            errors.append(f'Unmatched push: nesting level is {nesting_level} at the end of the stream.')
+
+        seen_ids = set()
+        duplicate_ids = []
+
+        for obj_id in index.obj_ids:
+            if obj_id in seen_ids:
+                duplicate_ids.append(obj_id)
+            else:
+                seen_ids.add(obj_id)
+
+        if duplicate_ids:
+            errors.append(f'Object IDs encountered more than once: {duplicate_ids[:16]}')
+
+        types = {}
+
+        for handle_id, count in collections.Counter(index.handle_ids).items():
+            if handle_id not in self.type_handles:
+                errors.append(f'{count} object(s) with unknown type handle {handle_id}.')
+                continue
+
+            types[self.type_handles[handle_id]['name']] = count
+
+        summary['num_datagrams'] = num_datagrams
+        summary['num_objects'] = len(index.obj_ids)
+        summary['num_file_datas'] = len(index.file_data_offsets)
+        summary['types'] = types
+        summary['unregistered_types'] = [name for name in types if not BamFactory.has_type(name)]
+        summary['valid'] = not errors
+        return summary
+
+    def walk_datagrams(self, f, index):
+        # Adds every datagram of a seekable BAM stream to the index, right after its header.
+        # Yields the opcode of every datagram.
+        index.version = self.version
+        index.file_endian = self.file_endian
+        index.stdfloat_double = self.stdfloat_double
+
+        position = f.tell()
+        stream_end = f.seek(0, os.SEEK_END)
+        f.seek(position)
+
+        while True:
+            num_bytes = self.read_stream_length(f)
+
+            if num_bytes is None:
+                break
+
+            start = f.tell()
+
+            if start + num_bytes > stream_end:
+                raise BAMException(f'Truncated datagram in BAM stream: expected {num_bytes} bytes, got {stream_end - start}.')
+
+            head = f.read(min(num_bytes, INDEX_PEEK_SIZE))
+            handle_count = len(self.type_handles)
+            read_long_pointers = self.read_long_pointers
+
+            try:
+                opcode = self.index_datagram(index, StructDatagramIterator(head), start, num_bytes)
+            except StructDatagramException:
+                if len(head) == num_bytes:
+                    raise
+
+                # The header of this datagram is longer than what we've peeked.
+                # Undo what we've read so far, and try again with the full datagram.
+                for handle_id in list(self.type_handles)[handle_count:]:
+                    del self.type_handles[handle_id]
+
+                self.read_long_pointers = read_long_pointers
+                f.seek(start)
+                opcode = self.index_datagram(index, StructDatagramIterator(f.read(num_bytes)), start, num_bytes)
+
+            f.seek(start + num_bytes)
+            yield opcode
+
+        index.type_handles = dict(self.type_handles)
+
+    def index_datagram(self, index, dgi, start, num_bytes):
+        # dgi might only hold the beginning of the datagram
+        opcode = self.read_opcode(dgi)
+
+        if opcode in (BamGlobals.BOC_push, BamGlobals.BOC_adjunct):
+            handle_id = self.read_handle(dgi)
+            obj_id = self.read_pointer(dgi)
+            offset = dgi.get_current_index()
+            index.add_object(obj_id, handle_id, start + offset, num_bytes - offset, self.read_long_pointers)
+        elif opcode == BamGlobals.BOC_remove:
+            # Freed object codes span the whole datagram.
+            if dgi.end - dgi.start < num_bytes:
+                raise StructDatagramException('Freed object codes were not read completely.')
+
+            self.read_freed_object_codes(dgi)
+        elif opcode == BamGlobals.BOC_file_data:
+            num_bytes = dgi.get_uint32()
+
+            if num_bytes == 0xFFFFFFFF:
+                num_bytes = dgi.get_uint64()
+
+            index.add_file_data(start + dgi.get_current_index(), num_bytes)
+
+        return opcode
+
+    def read_stream_length(self, f):
+        # Reads a datagram length prefix from the stream, or None at the end of it.
+        prefix = f.read(4)
+
+        if not prefix:
+            return None
+
+        if len(prefix) < 4:
+            raise BAMException('Truncated datagram length in BAM stream.')
+
+        num_bytes = UINT32.unpack(prefix)[0]
+
+        if num_bytes == 0xFFFFFFFF:
+            prefix = f.read(4)
+
+            if len(prefix) < 4:
+                raise BAMException('Truncated datagram length in BAM stream.')
+
+            num_bytes += UINT32.unpack(prefix)[0]
+
+        return num_bytes
+
+    def open_index(self, f, index=None):
+        # Opens a seekable BAM stream for random access.
+        # Objects are only read from it when they are requested through get_object.
+        if index is None:
+            start = f.tell()
+            index = self.build_index(f)
+            f.seek(start)
+
+        self.read_index_header(index)
+        self.object_index = index
+        self.index_stream = f
+
+    def read_index_header(self, index):
+        self.version = index.version
+        self.bam_major_ver, self.bam_minor_ver = self.version
+        self.file_endian = index.file_endian
+        self.stdfloat_double = index.stdfloat_double
+        self.reset_stream()
+        self.type_handles = dict(index.type_handles)
+
+    def load_from_index(self, path, index, mmap=False):
+        # Loads a BAM file using an index built beforehand, without walking its datagrams.
+        # With mmap, the file is memory-mapped, just like with load_path.
+        self.set_filename(path)
+
+        with open(path, 'rb') as f:
+            if mmap:
+                data = memoryview(mmaplib.mmap(f.fileno(), 0, access=mmaplib.ACCESS_READ))
+            else:
+                data = f.read()
+
+            stat = os.fstat(f.fileno())
+
+        self.zero_copy = mmap
+        self.read_index_header(index)
+
+        if mmap:
+            self.mapped_file = (stat.st_dev, stat.st_ino)
+
+        for position in range(len(index)):
+            obj_id, handle_id, offset, length, read_long_pointers = index.get_entry(position)
+            handle_name = self.type_handles[handle_id]['name']
+            obj = BamObjectRecord(handle_id, handle_name, obj_id, data, offset, length)
+
+            if obj_id in self.objects:
+                raise BAMException(f'Object ID {obj_id} ({handle_name}) was encountered twice in the BAM stream!')
+
+            if self.lazy_load and BamFactory.has_type(handle_name):
+                self.object_map.add_pending(obj, read_long_pointers, position)
+            else:
+                node = self.decode_object(obj, read_long_pointers, position)
+
+                if node is not None:
+                    self.object_map[obj_id] = node
+
+            self.add_object(obj)
+            self.read_long_pointers = read_long_pointers
+
+        for offset, length in zip(index.file_data_offsets, index.file_data_lengths):
+            file_data = BamFileData(data, offset, length)
+
+            if self.file_data_spill_size is not None and length >= self.file_data_spill_size:
+                file_data.spill()
+
+            self.file_datas.append(file_data)
+
+    def open_index_path(self, path, sidecar=True):
+        # Opens a BAM file for random access. With sidecar, the index is cached
+        # next to the BAM file and reused for as long as the file is unchanged.
+        index_path = path + '.idx'
+        index = None
+
+        if sidecar and os.path.exists(index_path):
+            index = BamIndex()
+
+            try:
+                with open(index_path, 'rb') as f:
+                    index.load(f)
+            except (BAMException, StructDatagramException):
+                # A damaged sidecar is as good as a missing one.
+                index = None
+
+            if index is not None and not index.matches_source(path):
+                index = None
+
+        f = open(path, 'rb')
+
+        try:
+            if index is None:
+                index = self.build_index(f)
+                index.set_source(path)
+
+                if sidecar:
+                    self.write_sidecar(index_path, index)
+
+            self.set_filename(path)
+            self.open_index(f, index)
+        except BaseException:
+            f.close()
+            raise
+
+        self.owns_index_stream = True
+
+    def write_sidecar(self, index_path, index):
+        # The sidecar is replaced in one go, so that it's never left half written.
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(index_path)))
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                index.write(f)
+
+            os.replace(temp_path, index_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def read_indexed_object(self, obj_id):
+        position = self.object_index.get_position(obj_id)
+
+        if position is None:
+            return None
+
+        obj_id, handle_id, offset, length, read_long_pointers = self.object_index.get_entry(position)
+        if self.stats is not None:
+            start = time.perf_counter()
+
+        self.index_stream.seek(offset)
+        data = self.index_stream.read(length)
+
+        if len(data) != length:
+            raise BAMException(f'Truncated object {obj_id} in BAM stream.')
+
+        handle_name = self.type_handles[handle_id]['name']
+
+        if self.stats is not None:
+            self.stats.record_io(length, time.perf_counter() - start)
+            self.stats.record_object(handle_name, obj_id, length)
+
+        return BamObjectRecord(handle_id, handle_name, obj_id, data)
+
+    def load_indexed_object(self, obj_id):
+        obj = self.read_indexed_object(obj_id)
+
+        if obj is None:
+            return None
+
+        position = self.object_index.get_position(obj_id)
+        read_long_pointers = bool(self.object_index.long_pointers[position])
+        self.add_object(obj)
+        node = self.decode_object(obj, read_long_pointers, position)
+
+        if node is not None:
+            self.object_map[obj_id] = node
+
+        return node
+
+    def read_indexed_file_data(self, i):
+        offset = self.object_index.file_data_offsets[i]
+        length = self.object_index.file_data_lengths[i]
+        self.index_stream.seek(offset)
+        return self.index_stream.read(length)
+
+    def iter_datagrams(self, f, chunk_size=CHUNK_SIZE):
+        # Reads the stream in chunks of chunk_size bytes, and yields
+        # an iterator over every datagram as soon as it is complete.
+        buffer = bytearray()
+        stats = self.stats
+
+        def fill(size):
+            while len(buffer) < size:
+                if stats is None:
+                    chunk = f.read(max(chunk_size, size - len(buffer)))
+                else:
+                    start = time.perf_counter()
+                    chunk = f.read(max(chunk_size, size - len(buffer)))
+                    stats.record_io(len(chunk), time.perf_counter() - start)
+
+                if not chunk:
+                    return False
+
+                buffer.extend(chunk)
+
+            return True
+
+        while fill(4):
+            num_bytes = UINT32.unpack_from(buffer)[0]
+            header_size = 4
+
+            if num_bytes == 0xFFFFFFFF:
+                if not fill(8):
+                    raise BAMException('Truncated datagram length in BAM stream.')
+
+                num_bytes += UINT32.unpack_from(buffer, 4)[0]
+                header_size = 8
+
+            if not fill(header_size + num_bytes):
+                raise BAMException(f'Truncated datagram in BAM stream: expected {num_bytes} bytes, got {len(buffer) - header_size}.')
+
+            with memoryview(buffer) as view:
+                data = bytes(view[header_size:header_size + num_bytes])
+
+            del buffer[:header_size + num_bytes]
+            yield StructDatagramIterator(data)
+
+        if buffer:
+            raise BAMException(f'Truncated datagram length in BAM stream: {len(buffer)} bytes left over.')
+
+    def iter_objects(self, f, deserialize=True, chunk_size=CHUNK_SIZE, keep_file_data=False):
+        # Yields an (obj, node) tuple for every object in the stream.
+        # node is the deserialized object, or None if its type is not registered.
+        # Nothing is kept after it has been yielded, apart from the type handles,
+        # and the embedded files with keep_file_data.
+        header = f.read(len(self.HEADER))
+
+        if header != self.HEADER:
+            if get_compression(header) is None:
+                raise BAMException('Invalid BAM header.')
+
+            with BamDecompressor(f, header, chunk_size) as decompressor:
+                yield from self.iter_objects(decompressor, deserialize, chunk_size, keep_file_data)
+
+            return
+
+        datagrams = self.iter_datagrams(f, chunk_size)
+        hdi = next(datagrams, None)
+
+        if hdi is None:
+            raise BAMException('Missing BAM header datagram.')
+
+        self.read_header(hdi)
+
+        for dgi in datagrams:
+            opcode = self.read_opcode(dgi)
+
+            if opcode == BamGlobals.BOC_push:
+                self.nesting_level += 1
+            elif opcode == BamGlobals.BOC_pop:
+                self.nesting_level -= 1
+                continue
+            elif opcode == BamGlobals.BOC_remove:
+                self.read_freed_object_codes(dgi)
+                continue
+            elif opcode == BamGlobals.BOC_file_data:
+                if keep_file_data:
+                    self.file_datas.append(self.read_file_data(dgi))
+
+                continue
+            elif opcode != BamGlobals.BOC_adjunct:
+                continue
+
+            obj = self.parse_object(dgi)
+
+            if deserialize:
+                node = self.create_object(obj)
+                # Streamed objects are never written back.
+                self.pta_definitions.pop(obj['obj_id'], None)
+                self.pta_references.pop(obj['obj_id'], None)
+            else:
+                node = None
+
+            yield obj, node
 
     def write_handle(self, dg, handle_id, written_handles):
         dg.add_uint16(handle_id)
@@ -340,46 +1367,117 @@ class BamFile(object):
             # Write all of our parent handles.
             self.write_handle(dg, handle_id, written_handles)
 
-    def write_file_data(self, dg, data):
-        num_bytes = len(data)
-
+    def write_file_data_size(self, dg, num_bytes):
         if num_bytes >= 0xFFFFFFFF:
             dg.add_uint32(0xFFFFFFFF)
             dg.add_uint64(num_bytes)
         else:
             dg.add_uint32(num_bytes)
 
-        dg.append_data(data)
+    def write_file_data(self, dg, data):
+        self.write_file_data_size(dg, len(data))
+
+        for chunk in self.iter_file_data_chunks(data):
+            dg.append_data(chunk)
+
+    def iter_file_data_chunks(self, data):
+        # Embedded files are BamFileData handles, or plain buffers added by hand.
+        if isinstance(data, BamFileData):
+            return data.iter_chunks()
+
+        return [data]
 
     def write_object(self, dg, opcode, obj=None, written_handles=None):
+        for chunk in self.pack_object(opcode, obj, written_handles):
+            dg.append_data(chunk)
+
+    def pack_object(self, opcode, obj=None, written_handles=None):
+        # Returns the chunks that make up an object datagram:
+        # its length prefix, its header and its payload.
+        # The payload is passed through without being copied.
         obj_dg = StructDatagram()
+        payload = b''
 
         if self.version >= (6, 21):
             obj_dg.add_uint8(opcode)
 
         if obj is not None:
             obj_id = obj['obj_id']
-            instance = self.object_map.get(obj_id)
+            # Objects that were never loaded still have their original payload.
+            instance = self.object_map.get_loaded(obj_id)
+
+            if instance is None and self.ptas_moved and self.object_map.is_pending(obj_id):
+                # We can't tell which arrays the original payload uses without loading it.
+                instance = self.object_map[obj_id]
 
             self.write_handle(obj_dg, obj['handle_id'], written_handles)
             self.write_pointer(obj_dg, obj_id)
 
-            if instance:
-                instance.save(self.version)
+            if instance and self.needs_save(instance):
+                definitions = self.pta_definitions.pop(obj_id, ())
+                self.pta_references.pop(obj_id, None)
+                self.current_obj_id = obj_id
+
+                try:
+                    if self.stats is None:
+                        instance.save(self.version)
+                    else:
+                        start = time.perf_counter()
+                        instance.save(self.version)
+                        self.stats.record_save(obj['handle_name'], obj_id, len(obj['data']), time.perf_counter() - start)
+                finally:
+                    self.current_obj_id = None
+
+                if set(self.pta_definitions.get(obj_id, ())) != set(definitions):
+                    self.ptas_moved = True
+            else:
+                self.written_ptas.update(self.pta_definitions.get(obj_id, ()))
 
-            obj_dg.append_data(obj['data'])
+            payload = obj['data']
 
-        self.write_datagram(obj_dg, dg)
+        header = obj_dg.get_view()
+        return [self.pack_datagram_length(len(header) + len(payload)), header, payload]
 
-    def write_datagram(self, dg, target_dg):
-        msg = dg.get_message()
+    def needs_save(self, instance):
+        if instance.obj_id in self.saved_objects and not instance.is_dirty():
+            # Already saved for this write, for example by a worker pool.
+            return False
 
-        target_dg.add_uint32(len(msg))
-        target_dg.append_data(msg)
+        if not self.track_dirty or instance.is_dirty():
+            return True
+
+        # The original payload defines arrays that were already written
+        # by someone else. Writing it out as-is would define them twice.
+        if any(ipd_pointer in self.written_ptas for ipd_pointer in self.pta_definitions.get(instance.obj_id, ())):
+            return True
+
+        # The original payload refers to arrays that are no longer defined before it,
+        # because the object that defined them has changed.
+        return any(ipd_pointer not in self.written_ptas for ipd_pointer in self.pta_references.get(instance.obj_id, ()))
+
+    def pack_file_data(self, data):
+        file_dg = StructDatagram()
+        file_dg.add_uint8(BamGlobals.BOC_file_data)
+        num_bytes = len(data)
+        self.write_file_data_size(file_dg, num_bytes)
+
+        # Spilled data is only read back when the chunks are consumed.
+        header = file_dg.get_view()
+        return itertools.chain([self.pack_datagram_length(len(header) + num_bytes), header], self.iter_file_data_chunks(data))
+
+    def pack_datagram_length(self, num_bytes):
+        dg = StructDatagram()
+
+        if num_bytes >= 0xFFFFFFFF:
+            dg.add_uint32(0xFFFFFFFF)
+            dg.add_uint32(num_bytes - 0xFFFFFFFF)
+        else:
+            dg.add_uint32(num_bytes)
 
-    def write(self, f):
+        return dg.get_message()
+
+    def pack_header(self):
         dg = StructDatagram()
-        dg.append_data(self.HEADER)
 
         if self.version >= (6, 27):
             header_size = 6
@@ -389,7 +1487,6 @@ class BamFile(object):
             header_size = 4
 
         bam_major_ver, bam_minor_ver = self.version
-        dg.add_uint32(header_size)
         dg.add_uint16(bam_major_ver)
         dg.add_uint16(bam_minor_ver)
 
@@ -399,23 +1496,311 @@ class BamFile(object):
         if header_size >= 6:
             dg.add_bool(self.stdfloat_double)
 
+        return [self.HEADER, self.pack_datagram_length(header_size), dg.get_view()]
+
+    def write_datagram(self, dg, target_dg):
+        msg = dg.get_view()
+
+        target_dg.append_data(self.pack_datagram_length(len(msg)))
+        target_dg.append_data(msg)
+
+    def begin_write(self):
+        # Resets the state that is built up while writing a BAM stream.
+        if self.object_index is not None:
+            # Only the objects fetched so far are in self.objects.
+            raise BAMException('Cannot write a BAM file opened for random access, load it instead.')
+
         self.written_handles = []
+        self.written_ptas = set()
+        self.ptas_moved = False
         self.write_long_pointers = False
 
-        if self.objects:
+    def end_write(self):
+        self.saved_objects.clear()
+
+    def iter_chunks(self):
+        # Yields the BAM file as a series of chunks, one datagram at a time.
+        # Objects are only serialized once we get to them.
+        self.begin_write()
+
+        try:
+            yield from self.pack_header()
+
+            for i, obj in enumerate(self.objects.values()):
+                if i == 0:
+                    opcode = BamGlobals.BOC_push
+                else:
+                    opcode = BamGlobals.BOC_adjunct
+
+                yield from self.pack_object(opcode, obj, self.written_handles)
+
+            for data in self.file_datas:
+                yield from self.pack_file_data(data)
+
+            if self.version >= (6, 21):
+                yield from self.pack_object(BamGlobals.BOC_pop)
+        finally:
+            # Objects saved ahead of this write must not be skipped by the next one.
+            self.end_write()
+
+    def write(self, f, compression=None, compression_level=6):
+        # The file is streamed out object by object.
+        # compression is 'zlib' (Panda3D .pz files), 'gzip' or None.
+        self.check_output(f)
+
+        if compression is not None:
+            # Datagrams are compressed as they are produced.
+            compressor = BamCompressor(f, compression, compression_level)
+            self.write(compressor)
+            return compressor.finish()
+
+        if self.stats is None:
+            return f.writelines(self.iter_chunks())
+
+        stats = self.stats
+        start = time.perf_counter()
+        save_time = stats.save_time
+        io_time = 0.0
+        num_bytes = 0
+
+        for chunk in self.iter_chunks():
+            chunk_start = time.perf_counter()
+            f.write(chunk)
+            io_time += time.perf_counter() - chunk_start
+            num_bytes += len(chunk)
+
+        stats.record_io(num_bytes, io_time)
+        # Everything that wasn't spent saving objects or writing them out was spent framing them.
+        stats.record_framing(num_bytes, time.perf_counter() - start - io_time - (stats.save_time - save_time))
+
+    def check_output(self, f):
+        # Writing over the file we have memory-mapped truncates it from under us.
+        if self.mapped_file is None:
+            return
+
+        try:
+            stat = os.fstat(f.fileno())
+        except (AttributeError, OSError):
+            return
+
+        if (stat.st_dev, stat.st_ino) == self.mapped_file:
+            raise BAMException('Cannot write a memory-mapped BAM file over itself, load it without mmap instead.')
+
+    async def awrite(self, writer, executor=None):
+        # Writes the BAM file to an asyncio.StreamWriter.
+        # Objects are serialized in batches in the executor, and the writer is drained after every batch.
+        loop = asyncio.get_running_loop()
+        chunks = self.iter_chunks()
+
+        while True:
+            batch = await loop.run_in_executor(executor, self.read_chunk_batch, chunks)
+
+            if not batch:
+                break
+
+            writer.writelines(batch)
+            await writer.drain()
+
+    def read_chunk_batch(self, chunks, batch_size=CHUNK_SIZE):
+        # Takes chunks from an iter_chunks generator until there are at least batch_size bytes.
+        batch = []
+        num_bytes = 0
+
+        for chunk in chunks:
+            batch.append(chunk)
+            num_bytes += len(chunk)
+
+            if num_bytes >= batch_size:
+                break
+
+        return batch
+
+    def append(self, f, objects=None, file_datas=(), index=None):
+        # Appends objects (by default, all of our objects) and embedded files to the end of an existing
+        # BAM stream, which must be opened for reading and writing. Nothing that's already in it is rewritten:
+        # the trailing pop is replaced, and type handles the stream does not define yet are added to it.
+        # The structure of the stream is walked to find its type handles, unless its index is given.
+        # A given index is updated with the appended objects, so that it can be passed again next time.
+        tail = BamFile()
+        tail.read_stream_header(f)
+
+        if self.bam_major_ver == -1:
+            self.version = tail.version
+            self.bam_major_ver, self.bam_minor_ver = tail.version
+            self.file_endian = tail.file_endian
+            self.stdfloat_double = tail.stdfloat_double
+        elif self.version != tail.version:
+            raise BAMException(f'Cannot append BAM version {self.version} objects to a BAM version {tail.version} stream.')
+
+        try:
+            fileno = f.fileno()
+        except (AttributeError, OSError):
+            # Not a file, so there's nothing to check the index against.
+            fileno = None
+
+        if index is None:
+            index = BamIndex()
+            opcode = None
+
+            for opcode in tail.walk_datagrams(f, index):
+                pass
+
+            if tail.version >= (6, 21) and opcode != BamGlobals.BOC_pop:
+                raise BAMException('Cannot append to a BAM stream that does not end with a pop.')
+
+            long_pointers = tail.read_long_pointers
+        else:
+            if fileno is not None and index.source_size != -1 and not index.matches_source(fileno):
+                raise BAMException('The BAM index is out of date: the BAM stream has changed since it was built.')
+
+            tail.type_handles = dict(index.type_handles)
+            long_pointers = bool(index.long_pointers[-1]) if len(index) else False
+
+        end = f.seek(0, os.SEEK_END)
+
+        if tail.version >= (6, 21):
+            # A pop datagram is a length of 1, followed by its opcode.
+            f.seek(end - 5)
+
+            if f.read(5) != b'\x01\x00\x00\x00\x01':
+                raise BAMException('Cannot append to a BAM stream that does not end with a pop.')
+
+            end -= 5
+
+        if objects is None:
             objects = list(self.objects.values())
-            self.write_object(dg, BamGlobals.BOC_push, objects[0], self.written_handles)
 
-            for obj in objects[1:]:
-                self.write_object(dg, BamGlobals.BOC_adjunct, obj, self.written_handles)
+        existing_ids = set(index.obj_ids)
 
-        for data in self.file_datas:
-            self.write_file_data(dg, data)
+        for obj in objects:
+            if obj['obj_id'] in existing_ids:
+                raise BAMException(f'Object ID {obj["obj_id"]} ({obj["handle_name"]}) is already in the BAM stream!')
 
-        if self.version >= (6, 21):
-            self.write_object(dg, BamGlobals.BOC_pop)
+        # Every handle that's already defined was written by the stream.
+        written_handles = list(tail.type_handles)
+        handle_map = {0: 0}
+
+        def map_handle(handle_id):
+            # Type handles are matched by name, new ones are added after the existing ones.
+            if handle_id in handle_map:
+                return handle_map[handle_id]
+
+            if handle_id not in self.type_handles:
+                raise BAMException(f'Unknown type handle {handle_id}.')
+
+            handle = self.type_handles[handle_id]
+            tail_handle_id = tail.get_handle_id_by_name(handle['name'])
+
+            if tail_handle_id is None:
+                parent_classes = [map_handle(parent_id) for parent_id in handle['parent_classes']]
+                tail_handle_id = max(tail.type_handles, default=0) + 1
+
+                if tail_handle_id > 0xFFFF:
+                    raise BAMException('Too many type handles in BAM stream.')
 
-        f.write(dg.get_message())
+                tail.register_handle(tail_handle_id, handle['name'], parent_classes)
+
+            handle_map[handle_id] = tail_handle_id
+            return tail_handle_id
+
+        # Deserialized objects are always encoded afresh: their payloads must continue
+        # the pointer state of the stream, and their arrays must not clash with the stream's.
+        self.object_map.load_all()
+        instances = [self.object_map.get_loaded(obj['obj_id']) for obj in objects]
+        next_ipd_pointer = 1
+
+        if any(instances):
+            # Arrays are never shared with the stream: they are defined again,
+            # under IPD pointers that the stream doesn't use yet.
+            next_ipd_pointer = tail.find_next_ipd_pointer(f, index)
+
+        # Everything is encoded before the stream is touched.
+        chunks = []
+        entries = []
+        num_bytes = 0
+        stream_state = (self.pta_map, self.pta_pointers, self.next_ipd_pointer)
+        self.begin_write()
+        self.pta_map = {}
+        self.pta_pointers = {}
+        self.next_ipd_pointer = next_ipd_pointer
+        self.write_long_pointers = long_pointers
+
+        try:
+            for i, (obj, instance) in enumerate(zip(objects, instances)):
+                if i == 0 and len(index) == 0:
+                    opcode = BamGlobals.BOC_push
+                else:
+                    opcode = BamGlobals.BOC_adjunct
+
+                obj_dg = StructDatagram()
+
+                if self.version >= (6, 21):
+                    obj_dg.add_uint8(opcode)
+
+                handle_id = map_handle(obj['handle_id'])
+                tail.write_handle(obj_dg, handle_id, written_handles)
+                # The payload is encoded right after the object ID, which might switch to long pointers.
+                self.write_pointer(obj_dg, obj['obj_id'])
+                obj_long_pointers = self.write_long_pointers
+
+                if instance:
+                    payload = instance.to_binary(self.version)
+                else:
+                    payload = obj['data']
+
+                header = obj_dg.get_view()
+                length = self.pack_datagram_length(len(header) + len(payload))
+                entries.append((obj['obj_id'], handle_id, num_bytes + len(length) + len(header), len(payload), obj_long_pointers))
+                chunks.extend((length, header, payload))
+                num_bytes += len(length) + len(header) + len(payload)
+        finally:
+            self.pta_map, self.pta_pointers, self.next_ipd_pointer = stream_state
+            self.end_write()
+
+        f.seek(end)
+        f.truncate()
+        f.writelines(chunks)
+
+        for obj_id, handle_id, offset, length, obj_long_pointers in entries:
+            index.add_object(obj_id, handle_id, end + offset, length, obj_long_pointers)
+
+        for data in file_datas:
+            file_chunks = tail.pack_file_data(data)
+            # The length and the header come first, the data is streamed after them.
+            framing = list(itertools.islice(file_chunks, 2))
+            num_bytes += sum(len(chunk) for chunk in framing)
+            index.add_file_data(end + num_bytes, len(data))
+            num_bytes += len(data)
+            f.writelines(framing)
+            f.writelines(file_chunks)
+
+        if tail.version >= (6, 21):
+            f.writelines(tail.pack_object(BamGlobals.BOC_pop))
+
+        index.type_handles = dict(tail.type_handles)
+
+        if fileno is not None:
+            f.flush()
+            index.set_source(fileno)
+
+    def find_next_ipd_pointer(self, f, index):
+        # Deserializes the registered objects of a BAM stream, to find the first IPD pointer it doesn't use.
+        for position in range(len(index)):
+            obj_id, handle_id, offset, length, read_long_pointers = index.get_entry(position)
+            handle_name = self.type_handles[handle_id]['name']
+
+            if not BamFactory.has_type(handle_name):
+                continue
+
+            f.seek(offset)
+            data = f.read(length)
+
+            if len(data) != length:
+                raise BAMException(f'Truncated object {obj_id} in BAM stream.')
+
+            self.decode_object(BamObjectRecord(handle_id, handle_name, obj_id, data), read_long_pointers, position)
+
+        return self.next_ipd_pointer
 
     def __str__(self):
         return 'Panda3D BAM file version {0}.{1} ({2}, {3})'.format(
@@ -0,0 +1,97 @@
+from p3bamboo.BamGlobals import BAMException
+import tempfile
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+CHUNK_SIZE = 1 << 20
+
+class BamFileData(object):
+    # A file embedded in the BAM stream (BOC_file_data).
+    # The data is a range of the buffer it was read from, or a temporary file
+    # it has been spilled to, so that it is never copied into memory of its own.
+    __slots__ = ('source', 'offset', 'length', 'file')
+
+    def __init__(self, source=b'', offset=0, length=None):
+        self.source = source
+        self.offset = offset
+
+        if length is None:
+            length = len(source) - offset
+
+        self.length = length
+        self.file = None
+
+    def get_size(self):
+        return self.length
+
+    def is_spilled(self):
+        return self.file is not None
+
+    def get_data(self):
+        # Returns the data as a view, or reads it back if it has been spilled.
+        if self.file is not None:
+            self.file.seek(0)
+            return self.file.read(self.length)
+
+        if self.offset == 0 and self.length == len(self.source):
+            return self.source
+
+        return memoryview(self.source)[self.offset:self.offset + self.length]
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        # Spilled data is streamed from disk chunk by chunk.
+        if self.file is None:
+            yield self.get_data()
+            return
+
+        self.file.seek(0)
+        remaining = self.length
+
+        while remaining > 0:
+            chunk = self.file.read(min(chunk_size, remaining))
+
+            if not chunk:
+                raise BAMException('Spilled file data is truncated.')
+
+            remaining -= len(chunk)
+            yield chunk
+
+    def spill(self, temp_dir=None):
+        # Moves the data to an anonymous temporary file, and lets go of the source buffer.
+        if self.file is not None:
+            return
+
+        f = tempfile.TemporaryFile(dir=temp_dir)
+        f.write(self.get_data())
+        self.file = f
+        self.source = b''
+        self.offset = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __len__(self):
+        return self.length
+
+    def __bytes__(self):
+        return bytes(self.get_data())
+
+    def __eq__(self, other):
+        if isinstance(other, BamFileData):
+            other = other.get_data()
+
+        return self.get_data() == other
+
+    def __reduce__(self):
+        # Neither views nor temporary files can be pickled, so the data is copied out.
+        return (BamFileData, (bytes(self.get_data()),))
+
+    def __repr__(self):
+        return f'BamFileData({self.length} bytes{", spilled" if self.file is not None else ""})'
@@ -49,4 +49,4 @@ def write_vec_arr(dg, arr):
     dg.add_uint32(num)
 
     for element in arr:
-        write_vec(dg, obj)
+        write_vec(dg, element)
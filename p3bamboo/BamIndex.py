@@ -0,0 +1,148 @@
+from array import array
+from p3bamboo.BamGlobals import BAMException
+from p3bamboo.StructDatagram import StructDatagram, StructDatagramIterator
+import os
+import sys
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+class BamIndex(object):
+    # An offset index of a BAM file: where every object's payload
+    # and every embedded file lives in the file, in stream order.
+    HEADER = b'p3bidx\x00\x01'
+
+    def __init__(self):
+        self.version = None
+        self.file_endian = 1
+        self.stdfloat_double = False
+        self.source_size = -1
+        self.source_mtime = -1
+        self.type_handles = {}
+        self.obj_ids = array('I')
+        self.handle_ids = array('H')
+        self.offsets = array('Q')
+        self.lengths = array('Q')
+        self.long_pointers = array('B')
+        self.file_data_offsets = array('Q')
+        self.file_data_lengths = array('Q')
+        self.positions = None
+
+    def set_source(self, path):
+        stat = os.stat(path)
+        self.source_size = stat.st_size
+        self.source_mtime = stat.st_mtime_ns
+
+    def matches_source(self, path):
+        stat = os.stat(path)
+        return self.source_size == stat.st_size and self.source_mtime == stat.st_mtime_ns
+
+    def add_object(self, obj_id, handle_id, offset, length, long_pointers):
+        # long_pointers is the pointer state right after the object's ID was read.
+        self.obj_ids.append(obj_id)
+        self.handle_ids.append(handle_id)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.long_pointers.append(long_pointers)
+        self.positions = None
+
+    def add_file_data(self, offset, length):
+        self.file_data_offsets.append(offset)
+        self.file_data_lengths.append(length)
+
+    def get_num_objects(self):
+        return len(self.obj_ids)
+
+    def get_num_file_datas(self):
+        return len(self.file_data_offsets)
+
+    def get_position(self, obj_id):
+        # Returns the index of the object in the BAM stream, or None.
+        if self.positions is None:
+            self.positions = {obj_id: position for position, obj_id in enumerate(self.obj_ids)}
+
+        return self.positions.get(obj_id)
+
+    def get_entry(self, position):
+        return (
+            self.obj_ids[position], self.handle_ids[position], self.offsets[position],
+            self.lengths[position], bool(self.long_pointers[position])
+        )
+
+    def __contains__(self, obj_id):
+        return self.get_position(obj_id) is not None
+
+    def __len__(self):
+        return len(self.obj_ids)
+
+    def get_arrays(self):
+        return [
+            self.obj_ids, self.handle_ids, self.offsets, self.lengths, self.long_pointers,
+            self.file_data_offsets, self.file_data_lengths
+        ]
+
+    def write(self, f):
+        dg = StructDatagram()
+        dg.append_data(self.HEADER)
+        dg.add_uint16(self.version[0])
+        dg.add_uint16(self.version[1])
+        dg.add_uint8(self.file_endian)
+        dg.add_bool(self.stdfloat_double)
+        dg.add_int64(self.source_size)
+        dg.add_int64(self.source_mtime)
+        dg.add_uint32(len(self.type_handles))
+
+        for handle_id, handle in self.type_handles.items():
+            dg.add_uint16(handle_id)
+            dg.add_string(handle['name'])
+            dg.add_uint8(len(handle['parent_classes']))
+            dg.add_uint16_array(handle['parent_classes'])
+
+        f.write(dg.get_view())
+
+        for values in self.get_arrays():
+            size_dg = StructDatagram()
+            size_dg.add_uint64(len(values))
+            f.write(size_dg.get_view())
+
+            if sys.byteorder == 'big':
+                values = array(values.typecode, values)
+                values.byteswap()
+
+            f.write(memoryview(values).cast('B'))
+
+    def load(self, f):
+        if f.read(len(self.HEADER)) != self.HEADER:
+            raise BAMException('Invalid BAM index header.')
+
+        di = StructDatagramIterator(f.read(), zero_copy=True)
+        self.version = (di.get_uint16(), di.get_uint16())
+        self.file_endian = di.get_uint8()
+        self.stdfloat_double = di.get_bool()
+        self.source_size = di.get_int64()
+        self.source_mtime = di.get_int64()
+        self.type_handles = {}
+
+        for _ in range(di.get_uint32()):
+            handle_id = di.get_uint16()
+            name = di.get_string()
+            parent_classes = di.get_uint16_array(di.get_uint8())
+            self.type_handles[handle_id] = {'name': name, 'parent_classes': parent_classes}
+
+        for values in self.get_arrays():
+            del values[:]
+            num_values = di.get_uint64()
+            values.frombytes(di.extract_bytes(num_values * values.itemsize))
+
+            if sys.byteorder == 'big':
+                values.byteswap()
+
+        self.positions = None
+
+        if di.get_remaining_size() > 0:
+            raise BAMException('Trailing data in BAM index.')
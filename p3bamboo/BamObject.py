@@ -10,12 +10,27 @@ import logging
   Date: 2020/10/16
 """
 class BamObject(object):
+    # Subclasses without __slots__ of their own still get a __dict__.
+    __slots__ = ('bam_file', 'bam_version', 'extra_data', 'obj_id', 'dirty', '__weakref__')
 
     def __init__(self, bam_file, bam_version):
         self.bam_file = bam_file
         self.bam_version = bam_version
         self.extra_data = None
         self.obj_id = -1
+        self.dirty = True
+
+    def mark_dirty(self):
+        # Modified objects must be marked dirty when the BAM file tracks
+        # dirty objects, or they'll be written out with their old data.
+        self.dirty = True
+
+        if self.bam_file is not None:
+            # Any payload saved ahead of the next write is out of date.
+            self.bam_file.saved_objects.discard(self.obj_id)
+
+    def is_dirty(self):
+        return self.dirty
 
     def to_binary(self, write_version=None):
         if write_version is None:
@@ -34,6 +49,7 @@ class BamObject(object):
             raise BAMException('Cannot save: object ID has not been set.')
 
         self.bam_file.objects[self.obj_id]['data'] = self.to_binary(write_version)
+        self.dirty = False
 
     def load_object(self, obj):
         self.obj_id = obj['obj_id']
@@ -47,6 +63,8 @@ class BamObject(object):
             if self.bam_file.warn_truncated_data:
                 logging.warning('Warning! Loading truncated data for {0}.'.format(obj['handle_name']))
 
+        self.dirty = False
+
     def load_type(self, type_constructor, di):
         obj = type_constructor(self.bam_file, self.bam_version)
         obj.load(di)
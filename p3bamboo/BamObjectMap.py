@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+class BamObjectMap(MutableMapping):
+    # Maps object IDs to deserialized BAM objects.
+    # Objects loaded lazily are kept as raw records until they are first accessed.
+
+    def __init__(self, bam_file):
+        self.bam_file = bam_file
+        self.loaded = {}
+        self.pending = OrderedDict()
+
+    def add_pending(self, obj, read_long_pointers, position):
+        # position is the index of the object in the BAM stream
+        self.pending[obj['obj_id']] = (obj, read_long_pointers, position)
+
+    def is_pending(self, obj_id):
+        return obj_id in self.pending
+
+    def get_loaded(self, obj_id):
+        return self.loaded.get(obj_id)
+
+    def load(self, obj_id):
+        obj, read_long_pointers, position = self.pending.pop(obj_id)
+        node = self.bam_file.decode_object(obj, read_long_pointers, position)
+
+        if node is not None:
+            self.loaded[obj_id] = node
+
+        return node
+
+    def load_before(self, position, condition):
+        # Loads pending objects that come before position in the BAM stream,
+        # in stream order, until the condition is met.
+        for obj_id, (obj, read_long_pointers, obj_position) in list(self.pending.items()):
+            if condition() or obj_position >= position:
+                break
+
+            if obj_id in self.pending:
+                self.load(obj_id)
+
+    def load_all(self):
+        while self.pending:
+            self.load(next(iter(self.pending)))
+
+    def clear(self):
+        self.loaded.clear()
+        self.pending.clear()
+
+    def __getitem__(self, obj_id):
+        if obj_id in self.pending:
+            self.load(obj_id)
+
+        return self.loaded[obj_id]
+
+    def __setitem__(self, obj_id, node):
+        self.pending.pop(obj_id, None)
+        self.loaded[obj_id] = node
+
+    def __delitem__(self, obj_id):
+        if obj_id in self.pending:
+            del self.pending[obj_id]
+        else:
+            del self.loaded[obj_id]
+
+    def __contains__(self, obj_id):
+        return obj_id in self.loaded or obj_id in self.pending
+
+    def __iter__(self):
+        return iter(list(self.loaded) + list(self.pending))
+
+    def __len__(self):
+        return len(self.loaded) + len(self.pending)
+
+    def __repr__(self):
+        return f'BamObjectMap(loaded={len(self.loaded)}, pending={len(self.pending)})'
@@ -0,0 +1,73 @@
+from collections.abc import MutableMapping
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+class BamObjectRecord(MutableMapping):
+    # A raw object in the BAM stream, behaving like the dict
+    # {'handle_id', 'handle_name', 'obj_id', 'data'}.
+    # The payload is stored as a range of a source buffer,
+    # so that objects don't need a view or a copy of their own.
+    __slots__ = ('handle_id', 'handle_name', 'obj_id', 'source', 'offset', 'length')
+    KEYS = ('handle_id', 'handle_name', 'obj_id', 'data')
+
+    def __init__(self, handle_id, handle_name, obj_id, source=b'', offset=0, length=None):
+        self.handle_id = handle_id
+        self.handle_name = handle_name
+        self.obj_id = obj_id
+        self.source = source
+        self.offset = offset
+
+        if length is None:
+            length = len(source) - offset
+
+        self.length = length
+
+    @property
+    def data(self):
+        if self.offset == 0 and self.length == len(self.source):
+            return self.source
+
+        return self.source[self.offset:self.offset + self.length]
+
+    @data.setter
+    def data(self, data):
+        self.source = data
+        self.offset = 0
+        self.length = len(data)
+
+    def get_size(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError('Cannot delete keys of a BAM object record.')
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __reduce__(self):
+        # Views can't be pickled, so the payload is copied out.
+        return (BamObjectRecord, (self.handle_id, self.handle_name, self.obj_id, bytes(self.data)))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
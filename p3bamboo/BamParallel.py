@@ -0,0 +1,182 @@
+from concurrent.futures import ProcessPoolExecutor
+from p3bamboo.BamBatch import init_worker
+from p3bamboo.BamFactory import BamFactory
+from p3bamboo.BamFile import BamFile
+import io
+import pickle
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+CHUNK_SIZE = 256
+
+class BamSerialObject(Exception):
+    # Raised in workers by objects that depend on the state of other objects.
+    pass
+
+class BamWorkerFile(BamFile):
+    # Stands in for the BAM file in worker processes.
+    # PTA arrays are shared between objects in stream order, so objects that
+    # use them can't be processed in isolation: they are sent back to be processed serially.
+
+    def read_array(self, di, reader, bulk=False):
+        raise BamSerialObject()
+
+    def write_array(self, dg, array, writer):
+        raise BamSerialObject()
+
+class BamPickler(pickle.Pickler):
+    # The BAM file is never pickled: objects refer to the one on the other side.
+
+    def __init__(self, f, bam_file):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.bam_file = bam_file
+
+    def persistent_id(self, obj):
+        if obj is self.bam_file:
+            return 'bam_file'
+
+        return None
+
+class BamUnpickler(pickle.Unpickler):
+
+    def __init__(self, f, bam_file):
+        pickle.Unpickler.__init__(self, f)
+        self.bam_file = bam_file
+
+    def persistent_load(self, pid):
+        if pid == 'bam_file':
+            return self.bam_file
+
+        raise pickle.UnpicklingError(f'Unknown persistent ID: {pid}')
+
+def dumps(value, bam_file):
+    f = io.BytesIO()
+    BamPickler(f, bam_file).dump(value)
+    return f.getvalue()
+
+def loads(data, bam_file):
+    return BamUnpickler(io.BytesIO(data), bam_file).load()
+
+def create_worker_file(header):
+    version, file_endian, stdfloat_double, type_handles, warn_truncated_data = header
+    bam = BamWorkerFile()
+    bam.version = version
+    bam.bam_major_ver, bam.bam_minor_ver = version
+    bam.file_endian = file_endian
+    bam.stdfloat_double = stdfloat_double
+    bam.type_handles = type_handles
+    bam.warn_truncated_data = warn_truncated_data
+    return bam
+
+def get_header(bam):
+    return (bam.version, bam.file_endian, bam.stdfloat_double, bam.type_handles, bam.warn_truncated_data)
+
+def decode_chunk(header, data):
+    # Returns (obj_id, node) pairs; node is None if it has to be decoded serially.
+    bam = create_worker_file(header)
+    results = []
+
+    for obj, read_long_pointers, position in loads(data, bam):
+        try:
+            node = bam.decode_object(obj, read_long_pointers, position)
+        except BamSerialObject:
+            node = None
+
+        results.append((obj['obj_id'], node))
+
+    return dumps(results, bam)
+
+def encode_chunk(header, data):
+    # Returns (obj_id, payload, switched) tuples; payload is None if it has to be encoded serially.
+    # switched is True if the payload itself switched to long pointers.
+    bam = create_worker_file(header)
+    results = []
+
+    for obj_id, instance, long_pointers in loads(data, bam):
+        # Pointers are written in the size they have at the object's position in the stream.
+        bam.write_long_pointers = long_pointers
+
+        try:
+            payload = instance.to_binary(bam.version)
+        except BamSerialObject:
+            payload = None
+
+        results.append((obj_id, payload, bam.write_long_pointers != long_pointers))
+
+    return dumps(results, bam)
+
+def map_chunks(bam, function, items, workers, chunk_size):
+    # Runs function over chunks of items in a worker pool, yielding the results in order.
+    header = get_header(bam)
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(dict(BamFactory.types),)) as executor:
+        futures = [executor.submit(function, header, dumps(chunk, bam)) for chunk in chunks]
+
+        for future in futures:
+            yield from loads(future.result(), bam)
+
+def decode_objects(bam, workers=None, chunk_size=CHUNK_SIZE):
+    # Deserializes all pending objects of a lazily loaded BAM file in a worker pool.
+    object_map = bam.object_map
+    items = list(object_map.pending.values())
+
+    for obj_id, node in map_chunks(bam, decode_chunk, items, workers, chunk_size):
+        if obj_id not in object_map.pending:
+            continue
+
+        if node is None:
+            # Decoded serially, in stream order: every object that comes before
+            # this one has already been loaded or popped off the pending list.
+            object_map.load(obj_id)
+        else:
+            del object_map.pending[obj_id]
+            object_map.loaded[obj_id] = node
+
+def encode_objects(bam, workers=None, chunk_size=CHUNK_SIZE):
+    # Serializes all loaded objects that need saving in a worker pool, ahead of write().
+    # Objects that must be serialized in order are left for write() to handle.
+    # Pointers switch to 32 bits from object 0xFFFF onwards, or from the first payload that refers to it.
+    positions = {obj_id: position for position, obj_id in enumerate(bam.objects)}
+    long_position = positions.get(0xFFFF, len(positions))
+    items = []
+
+    for obj_id, instance in bam.object_map.loaded.items():
+        if obj_id in bam.objects and bam.needs_save(instance):
+            items.append((obj_id, instance, positions[obj_id] >= long_position))
+
+    results = list(map_chunks(bam, encode_chunk, items, workers, chunk_size))
+    switch_position = min((positions[obj_id] for obj_id, payload, switched in results if switched), default=long_position)
+
+    for obj_id, payload, switched in results:
+        # Objects between the switch and object 0xFFFF were serialized with short pointers.
+        # They are left for write(), which switches at the right place.
+        if payload is not None and not switch_position <= positions[obj_id] < long_position:
+            instance = bam.object_map.loaded[obj_id]
+            bam.objects[obj_id]['data'] = payload
+            instance.dirty = False
+            bam.saved_objects.add(obj_id)
+
+def load(bam, f, workers=None, chunk_size=CHUNK_SIZE):
+    # Loads a BAM file, deserializing its objects in a worker pool.
+    # The objects are split out without being deserialized first.
+    lazy_load = bam.lazy_load
+    bam.lazy_load = True
+
+    try:
+        bam.load(f)
+    finally:
+        bam.lazy_load = lazy_load
+
+    decode_objects(bam, workers, chunk_size)
+
+def write(bam, f, workers=None, chunk_size=CHUNK_SIZE):
+    # Writes a BAM file, serializing its objects in a worker pool.
+    encode_objects(bam, workers, chunk_size)
+    bam.write(f)
@@ -0,0 +1,151 @@
+from p3bamboo.BamField import FIXED_TYPES, POINTER
+from p3bamboo.BamGlobals import BAMException
+from p3bamboo.BamObject import BamObject
+from p3bamboo.StructDatagram import get_struct
+import itertools
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+class BamSchemaObject(BamObject):
+    # A BAM object whose load and write methods are generated from a list of fields.
+    # Subclasses list their own fields in FIELDS, after the fields of their parent class.
+    # Runs of consecutive fixed-size fields are read and written with a single precompiled struct.
+    FIELDS = []
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.schema_fields = getattr(cls, 'schema_fields', []) + list(cls.__dict__.get('FIELDS', []))
+        # (version, stdfloat_double): (load, write)
+        cls.codecs = {}
+
+    @classmethod
+    def get_codec(cls, version, stdfloat_double):
+        codec = cls.codecs.get((version, stdfloat_double))
+
+        if codec is None:
+            codec = cls.codecs[(version, stdfloat_double)] = compile_codec(cls, version, stdfloat_double)
+
+        return codec
+
+    def load(self, di):
+        # The stdfloat width is only known once the BAM header has been read.
+        self.get_codec(self.bam_version, self.bam_file.stdfloat_double is True)[0](self, di)
+
+    def write(self, write_version, dg):
+        self.get_codec(write_version, self.bam_file.stdfloat_double is True)[1](self, dg)
+
+def get_variable_code(field, value):
+    # Returns the code that reads one element of a variable-size field, and the code that writes value.
+    if field.field_type == POINTER:
+        return 'bam_file.read_pointer(di)', f'bam_file.write_pointer(dg, {value})'
+
+    return f'di.get_{field.field_type}()', f'dg.add_{field.field_type}({value})'
+
+def compile_codec(cls, version, stdfloat_double):
+    fields = [field for field in cls.schema_fields if field.is_present(version)]
+    names = [field.name for field in fields]
+    # The count fields of variable-length arrays are written from the length of their array.
+    counted = {}
+
+    for i, field in enumerate(fields):
+        if isinstance(field.count, str):
+            if field.count not in names[:i]:
+                raise BAMException(f'Count field {field.count} of {cls.__name__}.{field.name} must come before it.')
+
+            counted[field.count] = field.name
+
+    def get_value(field):
+        if field.name in counted:
+            return f'len(obj.{counted[field.name]})'
+
+        return f'obj.{field.name}'
+
+    # Group consecutive fixed-size fields into runs
+    steps = []
+
+    for field in fields:
+        if field.is_fixed():
+            if steps and isinstance(steps[-1], list):
+                steps[-1].append(field)
+            else:
+                steps.append([field])
+        else:
+            steps.append(field)
+
+    namespace = {'chain': itertools.chain.from_iterable}
+    load_lines = ['def load(obj, di):', '    bam_file = obj.bam_file']
+    write_lines = ['def write(obj, dg):', '    bam_file = obj.bam_file']
+
+    for i, step in enumerate(steps):
+        if isinstance(step, list):
+            run_format = '<'
+            targets = []
+            assignments = []
+            arguments = []
+            position = 0
+
+            for field in step:
+                value_format, size = field.get_format(stdfloat_double)
+                count = 1 if field.count is None else field.count
+                num_values = count * size
+                run_format += f'{num_values}{value_format}'
+                end = position + num_values
+
+                if field.count is None and size == 1:
+                    targets.append(f'obj.{field.name}')
+                    assignments.append(f'    obj.{field.name} = values[{position}]')
+                    arguments.append(get_value(field))
+                elif field.count is None:
+                    assignments.append(f'    obj.{field.name} = values[{position}:{end}]')
+                    arguments.append(f'*obj.{field.name}')
+                elif size == 1:
+                    assignments.append(f'    obj.{field.name} = list(values[{position}:{end}])')
+                    arguments.append(f'*obj.{field.name}')
+                else:
+                    assignments.append(f'    obj.{field.name} = list(zip(*[iter(values[{position}:{end}])] * {size}))')
+                    arguments.append(f'*chain(obj.{field.name})')
+
+                position = end
+
+            namespace[f'STRUCT{i}'] = get_struct(run_format)
+
+            if len(targets) == len(step):
+                # Only scalars: unpack straight into the attributes.
+                load_lines.append(f'    {", ".join(targets)}, = di.extract_values(STRUCT{i})')
+            else:
+                load_lines.append(f'    values = di.extract_values(STRUCT{i})')
+                load_lines.extend(assignments)
+
+            write_lines.append(f'    dg.pack_struct(STRUCT{i}, {", ".join(arguments)})')
+        elif step.field_type in FIXED_TYPES:
+            # A variable-length array of fixed-size elements
+            value_format, size = step.get_format(stdfloat_double)
+            namespace[f'FORMAT{i}'] = f'<{value_format}'
+
+            if size == 1:
+                load_lines.append(f'    obj.{step.name} = di.get_array(FORMAT{i}, obj.{step.count})')
+                write_lines.append(f'    dg.add_array(FORMAT{i}, obj.{step.name})')
+            else:
+                load_lines.append(f'    obj.{step.name} = di.get_vec_array(FORMAT{i}, obj.{step.count}, {size})')
+                write_lines.append(f'    dg.add_vec_array(FORMAT{i}, obj.{step.name})')
+        elif step.count is None:
+            reader, writer = get_variable_code(step, get_value(step))
+            load_lines.append(f'    obj.{step.name} = {reader}')
+            write_lines.append(f'    {writer}')
+        else:
+            reader, writer = get_variable_code(step, 'value')
+            count = step.count if isinstance(step.count, int) else f'obj.{step.count}'
+            load_lines.append(f'    obj.{step.name} = [{reader} for _ in range({count})]')
+            write_lines.append(f'    for value in obj.{step.name}:')
+            write_lines.append(f'        {writer}')
+
+    source = '\n'.join(load_lines) + '\n\n' + '\n'.join(write_lines) + '\n'
+    exec(compile(source, f'<BamSchemaObject {cls.__name__} {version}>', 'exec'), namespace)
+    return namespace['load'], namespace['write']
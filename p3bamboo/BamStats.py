@@ -0,0 +1,121 @@
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+class BamTypeStats(object):
+    __slots__ = ('count', 'num_bytes', 'loads', 'load_time', 'saves', 'save_time')
+
+    def __init__(self):
+        self.count = 0
+        self.num_bytes = 0
+        self.loads = 0
+        self.load_time = 0.0
+        self.saves = 0
+        self.save_time = 0.0
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+class BamStats(object):
+    # Per-type object counts, payload sizes and (de)serialization times,
+    # and the time spent framing datagrams and doing I/O.
+    # Enable by assigning an instance to BamFile.stats.
+    # Callbacks are called as callback(event, handle_name, obj_id, num_bytes, elapsed),
+    # where event is one of 'object', 'load', 'save', 'framing' or 'io'.
+
+    def __init__(self):
+        self.types = {}
+        self.load_time = 0.0
+        self.save_time = 0.0
+        self.framing_time = 0.0
+        self.io_time = 0.0
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def clear(self):
+        self.types = {}
+        self.load_time = 0.0
+        self.save_time = 0.0
+        self.framing_time = 0.0
+        self.io_time = 0.0
+
+    def get_type_stats(self, handle_name):
+        stats = self.types.get(handle_name)
+
+        if stats is None:
+            stats = self.types[handle_name] = BamTypeStats()
+
+        return stats
+
+    def notify(self, event, handle_name, obj_id, num_bytes, elapsed):
+        for callback in self.callbacks:
+            callback(event, handle_name, obj_id, num_bytes, elapsed)
+
+    def record_object(self, handle_name, obj_id, num_bytes):
+        stats = self.get_type_stats(handle_name)
+        stats.count += 1
+        stats.num_bytes += num_bytes
+
+        if self.callbacks:
+            self.notify('object', handle_name, obj_id, num_bytes, 0.0)
+
+    def record_load(self, handle_name, obj_id, num_bytes, elapsed):
+        stats = self.get_type_stats(handle_name)
+        stats.loads += 1
+        stats.load_time += elapsed
+        self.load_time += elapsed
+
+        if self.callbacks:
+            self.notify('load', handle_name, obj_id, num_bytes, elapsed)
+
+    def record_save(self, handle_name, obj_id, num_bytes, elapsed):
+        stats = self.get_type_stats(handle_name)
+        stats.saves += 1
+        stats.save_time += elapsed
+        self.save_time += elapsed
+
+        if self.callbacks:
+            self.notify('save', handle_name, obj_id, num_bytes, elapsed)
+
+    def record_framing(self, num_bytes, elapsed):
+        self.framing_time += elapsed
+
+        if self.callbacks:
+            self.notify('framing', None, None, num_bytes, elapsed)
+
+    def record_io(self, num_bytes, elapsed):
+        self.io_time += elapsed
+
+        if self.callbacks:
+            self.notify('io', None, None, num_bytes, elapsed)
+
+    def to_dict(self):
+        return {
+            'types': {handle_name: stats.to_dict() for handle_name, stats in self.types.items()},
+            'load_time': self.load_time,
+            'save_time': self.save_time,
+            'framing_time': self.framing_time,
+            'io_time': self.io_time
+        }
+
+    def __str__(self):
+        lines = [f'{"Type":<32} {"Count":>10} {"Bytes":>14} {"Load (s)":>10} {"Save (s)":>10}']
+        types = sorted(self.types.items(), key=lambda item: item[1].load_time + item[1].save_time, reverse=True)
+
+        for handle_name, stats in types:
+            lines.append(f'{handle_name:<32} {stats.count:>10} {stats.num_bytes:>14} {stats.load_time:>10.4f} {stats.save_time:>10.4f}')
+
+        lines.append(f'Load: {self.load_time:.4f}s, save: {self.save_time:.4f}s, framing: {self.framing_time:.4f}s, I/O: {self.io_time:.4f}s')
+        return '\n'.join(lines)
@@ -1,22 +1,109 @@
+import itertools
+import mmap
 import struct
 
+# Precompiled codecs, so that packing a value does not have to parse its format string.
+STRUCTS = {}
+
+def get_struct(value_format):
+    value_struct = STRUCTS.get(value_format)
+
+    if value_struct is None:
+        value_struct = STRUCTS[value_format] = struct.Struct(value_format)
+
+    return value_struct
+
+def get_array_format(value_format, count):
+    # '<f' with a count of 3 becomes '<3f'
+    return f'{value_format[0]}{count}{value_format[1:]}'
+
+INT8 = get_struct('<b')
+INT16 = get_struct('<h')
+INT32 = get_struct('<i')
+INT64 = get_struct('<q')
+UINT8 = get_struct('<B')
+UINT16 = get_struct('<H')
+UINT32 = get_struct('<I')
+UINT64 = get_struct('<Q')
+FLOAT32 = get_struct('<f')
+FLOAT64 = get_struct('<d')
+BE_INT16 = get_struct('>h')
+BE_INT32 = get_struct('>i')
+BE_INT64 = get_struct('>q')
+BE_UINT16 = get_struct('>H')
+BE_UINT32 = get_struct('>I')
+BE_UINT64 = get_struct('>Q')
+BE_FLOAT32 = get_struct('>f')
+BE_FLOAT64 = get_struct('>d')
+
 class StructDatagramException(Exception):
     pass
 
 class StructDatagram(object):
+    MIN_CAPACITY = 64
+
+    def __init__(self, data=None, stdfloat_double=False, capacity=0):
+        # The message is held in self.buffer, of which only the first
+        # self.length bytes are in use. Data given to the constructor is
+        # referenced as-is, and only moved to a growable bytearray on the first write.
+        if data:
+            self.buffer = data
+            self.length = len(data)
+        else:
+            self.buffer = bytearray(capacity)
+            self.length = 0
 
-    def __init__(self, data=None, stdfloat_double=False):
-        self.data = data or b''
         self.stdfloat_double = stdfloat_double
 
+    @property
+    def data(self):
+        return self.get_message()
+
+    @data.setter
+    def data(self, data):
+        self.buffer = data or bytearray()
+        self.length = len(self.buffer)
+
     def get_message(self):
-        return self.data
+        if isinstance(self.buffer, bytes) and len(self.buffer) == self.length:
+            return self.buffer
+
+        return bytes(memoryview(self.buffer)[:self.length])
+
+    def get_view(self):
+        return memoryview(self.buffer)[:self.length]
 
     def get_length(self):
-        return len(self.data)
+        return self.length
+
+    def get_capacity(self):
+        return len(self.buffer)
 
     def clear(self):
-        self.data = b''
+        if isinstance(self.buffer, bytearray):
+            # Keep the capacity around, but never write into a buffer
+            # that might still be referenced through a view.
+            self.buffer = bytearray(len(self.buffer))
+        else:
+            self.buffer = bytearray()
+
+        self.length = 0
+
+    def reserve(self, size):
+        # Makes sure that size more bytes can be written in place.
+        # The buffer grows geometrically, so appends are amortized O(1).
+        required = self.length + size
+
+        if isinstance(self.buffer, bytearray) and len(self.buffer) >= required:
+            return
+
+        capacity = max(required, len(self.buffer) * 2, self.MIN_CAPACITY)
+        buffer = bytearray(capacity)
+        buffer[:self.length] = memoryview(self.buffer)[:self.length]
+
+        # We allocate a new buffer instead of resizing the old one:
+        # views handed out by get_view() stay valid this way.
+        self.buffer = buffer
 
     def set_stdfloat_double(self, stdfloat_double):
         self.stdfloat_double = stdfloat_double
@@ -25,40 +112,53 @@ class StructDatagram(object):
         return self.stdfloat_double
 
     def pack_value(self, value_format, value):
-        self.data += struct.pack(value_format, value)
+        return self.pack_struct(get_struct(value_format), value)
+
+    def pack_struct(self, value_struct, *values):
+        size = value_struct.size
+        self.reserve(size)
+        value_struct.pack_into(self.buffer, self.length, *values)
+        self.length += size
+
+    def add_array(self, value_format, values):
+        values = list(values)
+        self.pack_struct(struct.Struct(get_array_format(value_format, len(values))), *values)
+
+    def add_vec_array(self, value_format, values):
+        self.add_array(value_format, itertools.chain.from_iterable(values))
 
     def add_bool(self, value):
-        return self.pack_value('<B', bool(value))
+        return self.pack_struct(UINT8, bool(value))
 
     def add_int8(self, value):
-        return self.pack_value('<b', value)
+        return self.pack_struct(INT8, value)
 
     def add_int16(self, value):
-        return self.pack_value('<h', value)
+        return self.pack_struct(INT16, value)
 
     def add_int32(self, value):
-        return self.pack_value('<i', value)
+        return self.pack_struct(INT32, value)
 
     def add_int64(self, value):
-        return self.pack_value('<q', value)
+        return self.pack_struct(INT64, value)
 
     def add_uint8(self, value):
-        return self.pack_value('<B', value)
+        return self.pack_struct(UINT8, value)
 
     def add_uint16(self, value):
-        return self.pack_value('<H', value)
+        return self.pack_struct(UINT16, value)
 
     def add_uint32(self, value):
-        return self.pack_value('<I', value)
+        return self.pack_struct(UINT32, value)
 
     def add_uint64(self, value):
-        return self.pack_value('<Q', value)
+        return self.pack_struct(UINT64, value)
 
     def add_float32(self, value):
-        return self.pack_value('<f', value)
+        return self.pack_struct(FLOAT32, value)
 
     def add_float64(self, value):
-        return self.pack_value('<d', value)
+        return self.pack_struct(FLOAT64, value)
 
     def add_stdfloat(self, value):
         if self.stdfloat_double:
@@ -67,28 +167,73 @@ class StructDatagram(object):
         return self.add_float32(value)
 
     def add_be_int16(self, value):
-        return self.pack_value('>h', value)
+        return self.pack_struct(BE_INT16, value)
 
     def add_be_int32(self, value):
-        return self.pack_value('>i', value)
+        return self.pack_struct(BE_INT32, value)
 
     def add_be_int64(self, value):
-        return self.pack_value('>q', value)
+        return self.pack_struct(BE_INT64, value)
 
     def add_be_uint16(self, value):
-        return self.pack_value('>H', value)
+        return self.pack_struct(BE_UINT16, value)
 
     def add_be_uint32(self, value):
-        return self.pack_value('>I', value)
+        return self.pack_struct(BE_UINT32, value)
 
     def add_be_uint64(self, value):
-        return self.pack_value('>Q', value)
+        return self.pack_struct(BE_UINT64, value)
 
     def add_be_float32(self, value):
-        return self.pack_value('>f', value)
+        return self.pack_struct(BE_FLOAT32, value)
 
     def add_be_float64(self, value):
-        return self.pack_value('>d', value)
+        return self.pack_struct(BE_FLOAT64, value)
+
+    def add_int8_array(self, values):
+        return self.add_array('<b', values)
+
+    def add_int16_array(self, values):
+        return self.add_array('<h', values)
+
+    def add_int32_array(self, values):
+        return self.add_array('<i', values)
+
+    def add_int64_array(self, values):
+        return self.add_array('<q', values)
+
+    def add_uint8_array(self, values):
+        return self.add_array('<B', values)
+
+    def add_uint16_array(self, values):
+        return self.add_array('<H', values)
+
+    def add_uint32_array(self, values):
+        return self.add_array('<I', values)
+
+    def add_uint64_array(self, values):
+        return self.add_array('<Q', values)
+
+    def add_float32_array(self, values):
+        return self.add_array('<f', values)
+
+    def add_float64_array(self, values):
+        return self.add_array('<d', values)
+
+    def add_stdfloat_array(self, values):
+        if self.stdfloat_double:
+            return self.add_float64_array(values)
+
+        return self.add_float32_array(values)
+
+    def add_vec2_array(self, values):
+        return self.add_vec_array('<f', values)
+
+    def add_vec3_array(self, values):
+        return self.add_vec_array('<f', values)
+
+    def add_vec4_array(self, values):
+        return self.add_vec_array('<f', values)
 
     def add_string(self, value):
         if len(value) > 65535:
@@ -135,28 +280,35 @@ class StructDatagram(object):
         return self.append_data(value)
 
     def pad_bytes(self, size):
-        self.data += b'\x00' * size
+        self.reserve(size)
+        self.length += size
 
     def append_data(self, data):
-        if not isinstance(data, bytes):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
             data = str(data)
             data = data.encode('utf-8')
 
-        self.data += data
+        size = len(data) if not isinstance(data, memoryview) else data.nbytes
+        self.reserve(size)
+        self.buffer[self.length:self.length + size] = data
+        self.length += size
 
     def __bytes__(self):
-        return self.data
+        return self.get_message()
 
     get_data = get_message
 
     getData = get_data
     getMessage = get_message
+    getView = get_view
     getLength = get_length
+    getCapacity = get_capacity
 
     setStdfloatDouble = set_stdfloat_double
     getStdfloatDouble = get_stdfloat_double
 
     packValue = pack_value
+    packStruct = pack_struct
 
     addBool = add_bool
 
@@ -182,6 +334,23 @@ class StructDatagram(object):
     addBeFloat32 = add_be_float32
     addBeFloat64 = add_be_float64
 
+    addArray = add_array
+    addVecArray = add_vec_array
+    addInt8Array = add_int8_array
+    addInt16Array = add_int16_array
+    addInt32Array = add_int32_array
+    addInt64Array = add_int64_array
+    addUint8Array = add_uint8_array
+    addUint16Array = add_uint16_array
+    addUint32Array = add_uint32_array
+    addUint64Array = add_uint64_array
+    addFloat32Array = add_float32_array
+    addFloat64Array = add_float64_array
+    addStdfloatArray = add_stdfloat_array
+    addVec2Array = add_vec2_array
+    addVec3Array = add_vec3_array
+    addVec4Array = add_vec4_array
+
     addString = add_string
     addString32 = add_string32
     addZstring = add_z_string
@@ -196,39 +365,71 @@ class StructDatagram(object):
 
 class StructDatagramIterator(object):
 
-    def __init__(self, datagram=None, offset=0):
-        if datagram:
-            if isinstance(datagram, StructDatagram):
-                self.data = datagram.data[offset:]
-                self.stdfloat_double = datagram.stdfloat_double
-            elif isinstance(datagram, bytes):
-                self.data = datagram
-                self.stdfloat_double = False
+    def __init__(self, datagram=None, offset=0, zero_copy=False, size=None):
+        # The iterator reads self.data between self.start and self.end.
+        # In zero copy mode, self.data is a memoryview and extracted bytes
+        # are views into it, so they share memory with the source buffer.
+        self.stdfloat_double = False
+        self.zero_copy = zero_copy
+
+        if isinstance(datagram, StructDatagram):
+            self.stdfloat_double = datagram.stdfloat_double
+
+            if zero_copy:
+                data = datagram.get_view()
             else:
-                raise StructDatagramException('Invalid source datagram given.')
+                data = datagram.get_message()
+        elif isinstance(datagram, (bytes, bytearray, memoryview, mmap.mmap)):
+            data = datagram
+        elif datagram is None:
+            data = b''
+        else:
+            raise StructDatagramException('Invalid source datagram given.')
+
+        if zero_copy or not isinstance(data, bytes):
+            if not isinstance(data, memoryview):
+                data = memoryview(data)
+
+            if data.format != 'B' or data.ndim != 1:
+                data = data.cast('B')
+
+        self.data = data
+        self.start = offset
+        self.index = offset
+
+        if size is None:
+            self.end = len(data)
         else:
-            self.data = b''
-            self.stdfloat_double = False
+            self.end = offset + size
 
-        self.index = 0
+        if self.end > len(data):
+            raise StructDatagramException(f'Datagram overflow: Attempted to iterate {self.end - offset} bytes from index {offset}, datagram size {len(data)}')
 
     def get_remaining_size(self):
-        return len(self.data) - self.index
+        return self.end - self.index
 
     def get_remaining_bytes(self):
-        return self.data[self.index:]
+        return self.get_bytes(self.index, self.end)
 
     def get_datagram(self):
-        return StructDatagram(self.data, self.stdfloat_double)
+        return StructDatagram(self.get_bytes(self.start, self.end), self.stdfloat_double)
 
     def get_current_index(self):
-        return self.index
+        return self.index - self.start
+
+    def get_bytes(self, start, end):
+        value = self.data[start:end]
+
+        if not self.zero_copy and not isinstance(value, bytes):
+            value = bytes(value)
+
+        return value
 
     def skip_bytes(self, size):
         remaining_size = self.get_remaining_size()
 
         if remaining_size < size:
-            raise StructDatagramException(f'Datagram overflow: Attempted to skip {size} bytes, remaining size {remaining_size}, index {self.index}, datagram: {self.data}')
+            raise StructDatagramException(f'Datagram overflow: Attempted to skip {size} bytes, remaining size {remaining_size}, index {self.get_current_index()}')
 
         self.index += size
 
@@ -236,55 +437,94 @@ class StructDatagramIterator(object):
         remaining_size = self.get_remaining_size()
 
         if remaining_size < size:
-            raise StructDatagramException(f'Datagram overflow: Attempted to read {size} bytes, remaining size {remaining_size}, index {self.index}, datagram: {self.data}')
+            raise StructDatagramException(f'Datagram overflow: Attempted to read {size} bytes, remaining size {remaining_size}, index {self.get_current_index()}')
 
-        return self.data[self.index:self.index + size]
+        return self.get_bytes(self.index, self.index + size)
 
     def extract_bytes(self, size):
         value = self.peek_bytes(size)
         self.index += size
         return value
 
+    def extract_iterator(self, size, zero_copy=None):
+        # Returns an iterator over the next size bytes, sharing our buffer.
+        if zero_copy is None:
+            zero_copy = self.zero_copy
+
+        remaining_size = self.get_remaining_size()
+
+        if remaining_size < size:
+            raise StructDatagramException(f'Datagram overflow: Attempted to read {size} bytes, remaining size {remaining_size}, index {self.get_current_index()}')
+
+        dgi = StructDatagramIterator(self.data, self.index, zero_copy, size)
+        dgi.stdfloat_double = self.stdfloat_double
+        self.index += size
+        return dgi
+
+    def peek_values(self, value_struct):
+        size = value_struct.size
+
+        if self.end - self.index < size:
+            raise StructDatagramException(f'Datagram overflow: Attempted to read {size} bytes, remaining size {self.get_remaining_size()}, index {self.get_current_index()}')
+
+        return value_struct.unpack_from(self.data, self.index)
+
+    def extract_values(self, value_struct):
+        values = self.peek_values(value_struct)
+        self.index += value_struct.size
+        return values
+
+    def peek_struct(self, value_struct):
+        return self.peek_values(value_struct)[0]
+
+    def extract_struct(self, value_struct):
+        return self.extract_values(value_struct)[0]
+
     def peek_value(self, value_format):
-        size = struct.calcsize(value_format)
-        return struct.unpack(value_format, self.peek_bytes(size))[0]
+        return self.peek_struct(get_struct(value_format))
 
     def extract_value(self, value_format):
-        size = struct.calcsize(value_format)
-        return struct.unpack(value_format, self.extract_bytes(size))[0]
+        return self.extract_struct(get_struct(value_format))
+
+    def get_array(self, value_format, count):
+        return list(self.extract_values(struct.Struct(get_array_format(value_format, count))))
+
+    def get_vec_array(self, value_format, count, size):
+        values = iter(self.extract_values(struct.Struct(get_array_format(value_format, count * size))))
+        return list(zip(*[values] * size))
 
     def get_bool(self):
-        return bool(self.extract_value('<B'))
+        return bool(self.extract_struct(UINT8))
 
     def get_int8(self):
-        return self.extract_value('<b')
+        return self.extract_struct(INT8)
 
     def get_int16(self):
-        return self.extract_value('<h')
+        return self.extract_struct(INT16)
 
     def get_int32(self):
-        return self.extract_value('<i')
+        return self.extract_struct(INT32)
 
     def get_int64(self):
-        return self.extract_value('<q')
+        return self.extract_struct(INT64)
 
     def get_uint8(self):
-        return self.extract_value('<B')
+        return self.extract_struct(UINT8)
 
     def get_uint16(self):
-        return self.extract_value('<H')
+        return self.extract_struct(UINT16)
 
     def get_uint32(self):
-        return self.extract_value('<I')
+        return self.extract_struct(UINT32)
 
     def get_uint64(self):
-        return self.extract_value('<Q')
+        return self.extract_struct(UINT64)
 
     def get_float32(self):
-        return self.extract_value('<f')
+        return self.extract_struct(FLOAT32)
 
     def get_float64(self):
-        return self.extract_value('<d')
+        return self.extract_struct(FLOAT64)
 
     def get_stdfloat(self):
         if self.stdfloat_double:
@@ -293,28 +533,73 @@ class StructDatagramIterator(object):
         return self.get_float32()
 
     def get_be_int16(self):
-        return self.extract_value('>h')
+        return self.extract_struct(BE_INT16)
 
     def get_be_int32(self):
-        return self.extract_value('>i')
+        return self.extract_struct(BE_INT32)
 
     def get_be_int64(self):
-        return self.extract_value('>q')
+        return self.extract_struct(BE_INT64)
 
     def get_be_uint16(self):
-        return self.extract_value('>H')
+        return self.extract_struct(BE_UINT16)
 
     def get_be_uint32(self):
-        return self.extract_value('>I')
+        return self.extract_struct(BE_UINT32)
 
     def get_be_uint64(self):
-        return self.extract_value('>Q')
+        return self.extract_struct(BE_UINT64)
 
     def get_be_float32(self):
-        return self.extract_value('>f')
+        return self.extract_struct(BE_FLOAT32)
 
     def get_be_float64(self):
-        return self.extract_value('>d')
+        return self.extract_struct(BE_FLOAT64)
+
+    def get_int8_array(self, count):
+        return self.get_array('<b', count)
+
+    def get_int16_array(self, count):
+        return self.get_array('<h', count)
+
+    def get_int32_array(self, count):
+        return self.get_array('<i', count)
+
+    def get_int64_array(self, count):
+        return self.get_array('<q', count)
+
+    def get_uint8_array(self, count):
+        return self.get_array('<B', count)
+
+    def get_uint16_array(self, count):
+        return self.get_array('<H', count)
+
+    def get_uint32_array(self, count):
+        return self.get_array('<I', count)
+
+    def get_uint64_array(self, count):
+        return self.get_array('<Q', count)
+
+    def get_float32_array(self, count):
+        return self.get_array('<f', count)
+
+    def get_float64_array(self, count):
+        return self.get_array('<d', count)
+
+    def get_stdfloat_array(self, count):
+        if self.stdfloat_double:
+            return self.get_float64_array(count)
+
+        return self.get_float32_array(count)
+
+    def get_vec2_array(self, count):
+        return self.get_vec_array('<f', count, 2)
+
+    def get_vec3_array(self, count):
+        return self.get_vec_array('<f', count, 3)
+
+    def get_vec4_array(self, count):
+        return self.get_vec_array('<f', count, 4)
 
     def get_string(self):
         length = self.get_uint16()
@@ -327,18 +612,18 @@ class StructDatagramIterator(object):
     def get_z_string(self):
         length = 0
 
-        try:
-            while self.data[self.index + length] != 0:
-                length += 1
-        except IndexError:
-            raise StructDatagramException(f'Zero terminated string was not terminated at index {self.index}, datagram: {self.data}')
+        while self.index + length < self.end and self.data[self.index + length] != 0:
+            length += 1
+
+        if self.index + length >= self.end:
+            raise StructDatagramException(f'Zero terminated string was not terminated at index {self.get_current_index()}')
 
         value = self.get_fixed_string(length)
         self.skip_bytes(1)
         return value
 
     def get_fixed_string(self, size):
-        return self.extract_bytes(size).decode('utf-8')
+        return str(self.extract_bytes(size), 'utf-8')
 
     def get_wstring(self):
         return self.get_string32()
@@ -347,42 +632,42 @@ class StructDatagramIterator(object):
         length = self.get_uint16()
         return self.extract_bytes(length)
 
-    def add_blob32(self, value):
+    def get_blob32(self):
         length = self.get_uint32()
         return self.extract_bytes(length)
 
     def peek_bool(self):
-        return bool(self.peek_value('<B'))
+        return bool(self.peek_struct(UINT8))
 
     def peek_int8(self):
-        return self.peek_value('<b')
+        return self.peek_struct(INT8)
 
     def peek_int16(self):
-        return self.peek_value('<h')
+        return self.peek_struct(INT16)
 
     def peek_int32(self):
-        return self.peek_value('<i')
+        return self.peek_struct(INT32)
 
     def peek_int64(self):
-        return self.peek_value('<q')
+        return self.peek_struct(INT64)
 
     def peek_uint8(self):
-        return self.peek_value('<B')
+        return self.peek_struct(UINT8)
 
     def peek_uint16(self):
-        return self.peek_value('<H')
+        return self.peek_struct(UINT16)
 
     def peek_uint32(self):
-        return self.peek_value('<I')
+        return self.peek_struct(UINT32)
 
     def peek_uint64(self):
-        return self.peek_value('<Q')
+        return self.peek_struct(UINT64)
 
     def peek_float32(self):
-        return self.peek_value('<f')
+        return self.peek_struct(FLOAT32)
 
     def peek_float64(self):
-        return self.peek_value('<d')
+        return self.peek_struct(FLOAT64)
 
     def peek_stdfloat(self):
         if self.stdfloat_double:
@@ -391,50 +676,50 @@ class StructDatagramIterator(object):
         return self.peek_float32()
 
     def peek_be_int16(self):
-        return self.peek_value('>h')
+        return self.peek_struct(BE_INT16)
 
     def peek_be_int32(self):
-        return self.peek_value('>i')
+        return self.peek_struct(BE_INT32)
 
     def peek_be_int64(self):
-        return self.peek_value('>q')
+        return self.peek_struct(BE_INT64)
 
     def peek_be_uint16(self):
-        return self.peek_value('>H')
+        return self.peek_struct(BE_UINT16)
 
     def peek_be_uint32(self):
-        return self.peek_value('>I')
+        return self.peek_struct(BE_UINT32)
 
     def peek_be_uint64(self):
-        return self.peek_value('>Q')
+        return self.peek_struct(BE_UINT64)
 
     def peek_be_float32(self):
-        return self.peek_value('>f')
+        return self.peek_struct(BE_FLOAT32)
 
     def peek_be_float64(self):
-        return self.peek_value('>d')
+        return self.peek_struct(BE_FLOAT64)
 
     def peek_string(self):
         length = self.peek_uint16()
-        return self.peek_bytes(2 + length).decode('utf-8')[2:]
+        return str(self.peek_bytes(2 + length)[2:], 'utf-8')
 
     def peek_string32(self):
         length = self.peek_uint32()
-        return self.peek_bytes(4 + length).decode('utf-8')[4:]
+        return str(self.peek_bytes(4 + length)[4:], 'utf-8')
 
     def peek_z_string(self):
         length = 0
 
-        try:
-            while self.data[self.index + length] != 0:
-                length += 1
-        except IndexError:
-            raise StructDatagramException(f'Zero terminated string was not terminated at index {self.index}, datagram: {self.data}')
+        while self.index + length < self.end and self.data[self.index + length] != 0:
+            length += 1
+
+        if self.index + length >= self.end:
+            raise StructDatagramException(f'Zero terminated string was not terminated at index {self.get_current_index()}')
 
         return self.peek_fixed_string(length)
 
     def peek_fixed_string(self, size):
-        return self.peek_bytes(size).decode('utf-8')
+        return str(self.peek_bytes(size), 'utf-8')
 
     def peek_wstring(self):
         return self.peek_string32()
@@ -443,7 +728,7 @@ class StructDatagramIterator(object):
         length = self.peek_uint16()
         return self.peek_bytes(2 + length)[2:]
 
-    def peek_blob32(self, value):
+    def peek_blob32(self):
         length = self.peek_uint32()
         return self.peek_bytes(4 + length)[4:]
 
@@ -455,7 +740,12 @@ class StructDatagramIterator(object):
     skipBytes = skip_bytes
     peekBytes = peek_bytes
     extractBytes = extract_bytes
+    extractIterator = extract_iterator
 
+    peekValues = peek_values
+    extractValues = extract_values
+    peekStruct = peek_struct
+    extractStruct = extract_struct
     peekValue = peek_value
     extractValue = extract_value
 
@@ -483,6 +773,23 @@ class StructDatagramIterator(object):
     getBeFloat32 = get_be_float32
     getBeFloat64 = get_be_float64
 
+    getArray = get_array
+    getVecArray = get_vec_array
+    getInt8Array = get_int8_array
+    getInt16Array = get_int16_array
+    getInt32Array = get_int32_array
+    getInt64Array = get_int64_array
+    getUint8Array = get_uint8_array
+    getUint16Array = get_uint16_array
+    getUint32Array = get_uint32_array
+    getUint64Array = get_uint64_array
+    getFloat32Array = get_float32_array
+    getFloat64Array = get_float64_array
+    getStdfloatArray = get_stdfloat_array
+    getVec2Array = get_vec2_array
+    getVec3Array = get_vec3_array
+    getVec4Array = get_vec4_array
+
     getString = get_string
     getString32 = get_string32
     getZstring = get_z_string
@@ -490,7 +797,7 @@ class StructDatagramIterator(object):
     getWstring = get_wstring
 
     getBlob = get_blob
-    getBlob32 = add_blob32
+    getBlob32 = get_blob32
 
     peekBool = peek_bool
 
@@ -523,4 +830,4 @@ class StructDatagramIterator(object):
     peekWstring = peek_wstring
 
     peekBlob = peek_blob
-    peekBlob32 = add_blob32
+    peekBlob32 = peek_blob32
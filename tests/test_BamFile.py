@@ -0,0 +1,182 @@
+from benchmarks.generate import BenchmarkMesh, MESH_TYPE, generate_bam
+from p3bamboo.BamFactory import BamFactory
+from p3bamboo.BamFile import BamFile
+from p3bamboo.BamGlobals import BAMException
+from p3bamboo.BamObject import BamObject
+from p3bamboo.BamObjectRecord import BamObjectRecord
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+class Link(BamObject):
+
+    def load(self, di):
+        self.target = self.bam_file.read_pointer(di)
+
+    def write(self, write_version, dg):
+        self.bam_file.write_pointer(dg, self.target)
+
+def create_bam():
+    bam = BamFile()
+    bam.version = (6, 45)
+    bam.bam_major_ver, bam.bam_minor_ver = bam.version
+    bam.file_endian = 1
+    bam.stdfloat_double = False
+    return bam
+
+def make_links(obj_ids):
+    # Every object points back to an earlier object.
+    bam = create_bam()
+    bam.register_handle(1, 'Link', [])
+
+    for obj_id in obj_ids:
+        node = Link(bam, bam.version)
+        node.obj_id = obj_id
+        node.target = obj_id // 2 + 1
+        bam.add_object(BamObjectRecord(1, 'Link', obj_id))
+        bam.object_map[obj_id] = node
+
+    return bam
+
+def make_mesh(bam, obj_id, vertices):
+    node = BenchmarkMesh(bam, bam.version)
+    node.obj_id = obj_id
+    node.vertices = vertices
+    node.indices = list(range(len(vertices)))
+    bam.add_object(BamObjectRecord(bam.get_handle_id_by_name(MESH_TYPE), MESH_TYPE, obj_id))
+    bam.object_map[obj_id] = node
+    return node
+
+def write_bytes(bam):
+    f = io.BytesIO()
+    bam.write(f)
+    return f.getvalue()
+
+def load_bytes(data):
+    bam = BamFile()
+    bam.load(io.BytesIO(data))
+    return bam
+
+def get_meshes(bam):
+    return {node.obj_id: ([tuple(vertex) for vertex in node.vertices], list(node.indices)) for node in bam.get_objects_of_type(MESH_TYPE)}
+
+class BamFileAppendTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        for name, handle_type in (('Link', Link), (MESH_TYPE, BenchmarkMesh)):
+            if not BamFactory.has_type(name):
+                BamFactory.register_type(name, handle_type)
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'test.bam')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, bam):
+        with open(self.path, 'wb') as f:
+            bam.write(f)
+
+    def append_file(self, bam, objects=None, index=None):
+        with open(self.path, 'r+b') as f:
+            bam.append(f, objects, index=index)
+
+    def read_file(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_append_long_pointers(self):
+        # Object 0xFFFF switches to long pointers in the middle of the appended objects.
+        self.write_file(make_links(range(1, 65531)))
+        self.append_file(make_links(range(65531, 65561)))
+
+        data = self.read_file()
+        self.assertEqual(data, write_bytes(make_links(range(1, 65561))))
+        self.assertEqual(load_bytes(data).get_object(65560).target, 65560 // 2 + 1)
+
+    def test_append_shared_arrays(self):
+        full_bytes = write_bytes(generate_bam(300, 32, pta_size=8))
+        expected = get_meshes(load_bytes(full_bytes))
+
+        for track_dirty in (False, True):
+            with self.subTest(track_dirty=track_dirty):
+                full = BamFile()
+                full.track_dirty = track_dirty
+                full.load(io.BytesIO(full_bytes))
+                records = list(full.objects.values())
+
+                base = load_bytes(full_bytes)
+
+                for obj in records[200:]:
+                    base.remove_object(obj['obj_id'])
+
+                self.write_file(base)
+                self.append_file(full, records[200:])
+
+                bam = load_bytes(self.read_file())
+                self.assertEqual(len(bam.objects), 300)
+                self.assertEqual(get_meshes(bam), expected)
+                self.assertFalse(any(node.extra_data for node in bam.get_objects_of_type(MESH_TYPE)))
+
+    def test_append_new_mesh(self):
+        base = generate_bam(40, 32, pta_size=8)
+        self.write_file(base)
+        expected = get_meshes(load_bytes(self.read_file()))
+
+        new = create_bam()
+        new.register_handle(1, MESH_TYPE, [])
+        make_mesh(new, 1000, [(1.0, 2.0, 3.0), (4.0, 5.0, 6.0)])
+        self.append_file(new)
+
+        expected[1000] = ([(1.0, 2.0, 3.0), (4.0, 5.0, 6.0)], [0, 1])
+        self.assertEqual(get_meshes(load_bytes(self.read_file())), expected)
+
+    def test_append_index(self):
+        self.write_file(make_links(range(1, 11)))
+
+        with open(self.path, 'rb') as f:
+            index = BamFile().build_index(f)
+
+        index.set_source(self.path)
+
+        # A new type in every append: the index must learn about it.
+        for i, obj_ids in enumerate((range(11, 21), range(21, 31))):
+            new = make_links(obj_ids)
+            new.register_handle(2, f'Extra{i}', [1])
+            new.add_object(BamObjectRecord(2, f'Extra{i}', 1000 + i, b''))
+            self.append_file(new, index=index)
+
+        bam = load_bytes(self.read_file())
+        self.assertEqual(len(bam.objects), 32)
+        self.assertEqual(bam.get_object(30).target, 16)
+        self.assertEqual(len(index), 32)
+        self.assertEqual(sorted(handle['name'] for handle in bam.type_handles.values()), ['Extra0', 'Extra1', 'Link'])
+
+        # Object IDs that were appended before are caught.
+        with self.assertRaises(BAMException):
+            self.append_file(make_links([25]), index=index)
+
+        # So are indexes of a file that has been changed since.
+        with open(self.path, 'rb') as f:
+            other_index = BamFile().build_index(f)
+
+        other_index.set_source(self.path)
+        self.append_file(make_links([40]), index=index)
+
+        with self.assertRaises(BAMException):
+            self.append_file(make_links([41]), index=other_index)
+
+if __name__ == '__main__':
+    unittest.main()
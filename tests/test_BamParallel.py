@@ -0,0 +1,85 @@
+from p3bamboo import BamParallel
+from p3bamboo.BamFactory import BamFactory
+from p3bamboo.BamFile import BamFile
+from p3bamboo.BamObject import BamObject
+from p3bamboo.BamObjectRecord import BamObjectRecord
+import io
+import unittest
+
+"""
+  P3BAMBOO
+  Panda3D BAM file library
+
+  Author: Disyer
+  Date: 2020/10/16
+"""
+
+# Enough objects for pointers to switch to 32 bits
+NUM_OBJECTS = 0xFFFF + 1000
+
+class Link(BamObject):
+
+    def load(self, di):
+        self.target = self.bam_file.read_pointer(di)
+
+    def write(self, write_version, dg):
+        self.bam_file.write_pointer(dg, self.target)
+
+def make_bam(forward_id=None):
+    # Every object points back to an earlier object.
+    # The object forward_id points ahead to object 0xFFFF, which switches to long pointers early.
+    bam = BamFile()
+    bam.version = (6, 45)
+    bam.bam_major_ver, bam.bam_minor_ver = bam.version
+    bam.file_endian = 1
+    bam.stdfloat_double = False
+    bam.register_handle(1, 'Link', [])
+
+    for obj_id in range(1, NUM_OBJECTS + 1):
+        node = Link(bam, bam.version)
+        node.obj_id = obj_id
+        node.target = 0xFFFF if obj_id == forward_id else obj_id // 2 + 1
+        bam.add_object(BamObjectRecord(1, 'Link', obj_id))
+        bam.object_map[obj_id] = node
+
+    return bam
+
+def write_bam(bam, workers=None, chunk_size=None):
+    f = io.BytesIO()
+
+    if workers is None:
+        bam.write(f)
+    else:
+        BamParallel.write(bam, f, workers, chunk_size)
+
+    return f.getvalue()
+
+class BamParallelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if not BamFactory.has_type('Link'):
+            BamFactory.register_type('Link', Link)
+
+    def check_write(self, forward_id):
+        expected = write_bam(make_bam(forward_id))
+
+        for chunk_size in (256, 5000):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(write_bam(make_bam(forward_id), 2, chunk_size), expected)
+
+        bam = BamFile()
+        bam.load(io.BytesIO(expected))
+        self.assertEqual(bam.get_object(NUM_OBJECTS).target, NUM_OBJECTS // 2 + 1)
+
+        if forward_id is not None:
+            self.assertEqual(bam.get_object(forward_id).target, 0xFFFF)
+
+    def test_write_long_pointers(self):
+        self.check_write(None)
+
+    def test_write_long_pointers_forward_reference(self):
+        self.check_write(65000)
+
+if __name__ == '__main__':
+    unittest.main()